@@ -1,28 +1,28 @@
 string model_name = ...;
+string data_folder = ...;
 
 main {
   var model_name = thisOplModel.dataElements.model_name;
   if (model_name == "macro") {
   	writeln("\nMACRO MODEL\n")
-    var inputFolderPath = "simulation/model_input_macro/";
     var modelFile = "macro.mod";
   }    
   else if (model_name == "micro") {
   	writeln("\nMICRO MODEL\n")
-    var inputFolderPath = "simulation/model_input_micro/";
     var modelFile = "micro.mod";
   }    
   else if (model_name == "migration") {
   	writeln("\nMIGRATION MODEL\n")
-    var inputFolderPath = "simulation/model_input_migration/";
     var modelFile = "micro.mod";
   }    
   else if (model_name == "pm_manager") {
   	writeln("\nPM MANAGER\n")
-    var inputFolderPath = "simulation/pm_manager/input/";
     var modelFile = "micro.mod";
   }    
 
+  // Input folder of this solve, concurrent solves each have their own
+  var inputFolderPath = thisOplModel.dataElements.data_folder;
+
   // Define file names
   var folderPath = "model/";
   var physicalMachinesFile = "physical_machines.dat";
@@ -66,11 +66,29 @@ main {
     is_first_migration_vec.setStart(cplex);   
     is_run_vec.setStart(cplex);   
   }    
+  else {
+  	writeln("\nSetting initial solution...\n")
+  	
+  	var allocation_vec = new IloOplCplexVectors();
+  	var is_on_vec = new IloOplCplexVectors();
+  	
+    allocation_vec.attach(model.allocation,model.allocation_init);
+    is_on_vec.attach(model.is_on,model.is_on_init);
+    
+    allocation_vec.setStart(cplex);   
+    is_on_vec.setStart(cplex);   
+  }
   
   if (cplex.solve()) {
     
     writeln(model.printSolution());
     
+    // Gap of the returned incumbent, non-zero when the time limit was reached
+    writeln("mip_gap = " + cplex.getMIPRelativeGap() + ";");
+    
+    // CPLEX status of the solve, 101 and 102 when it reached optimality or the gap
+    writeln("cplex_status = " + cplex.getCplexStatus() + ";");
+    
     write("cpu_load = [");
     for (var pm in model.physical_machines) {
         write(" " + model.cpu_load[pm]);
@@ -83,6 +101,17 @@ main {
     }
 	write(" ]\n");
 	
+    // Sparse allocation of the micro, migration and PM manager models
+    if (model_name != "macro") {
+      write("allocation_pairs = [");
+      for (var a in model.assignments) {
+        if (model.allocation[a] > 0) {
+          write(" <" + a.vm + " " + a.pm + " " + model.allocation[a] + ">");
+        }
+      }
+      write(" ]\n");
+    }
+	
     write("Virtual Machines IDs: [");
     for (var vm in model.virtual_machines) {
       write(" " + vm.id);
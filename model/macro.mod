@@ -57,11 +57,23 @@ tuple Point {
   float y;
 }
 
+// Virtual Machines kept in place on a Physical Machine, not part of the decisions
+tuple ResidualLoad {
+  key int pm;
+  ArchitectureInt requested;
+  int count;
+}
+
 // Data
 {PhysicalMachine} physical_machines = ...;
 {VirtualMachine} virtual_machines = ...;
 int nb_points = ...;
-Point energy_intensity_function[pm in physical_machines][1..nb_points]= ...;
+{int} pm_types = ...;
+Point energy_intensity_function[pm_types][1..nb_points]= ...;
+{ResidualLoad} residual_loads = ...;
+float fixed_migration_penalty = ...;
+
+ResidualLoad residual[pm in physical_machines] = item(residual_loads, <pm.id>);
 
 float remaining_run_time[vm in virtual_machines] = vm.run.total_time - vm.run.current_time;
 float remaining_migration_time[vm in virtual_machines] = vm.migration.total_time - vm.migration.current_time;
@@ -80,11 +92,11 @@ int was_migrating_from[vm in virtual_machines][pm in physical_machines] =
 int M = card(virtual_machines);
 
 // Energy consumption in 1 second time period of each Physical Machine, depending by the load
-float slopeBeforePoint[pm in physical_machines][p in 1..nb_points]=
-  (p == 1) ? 0 : (energy_intensity_function[pm][p].y - energy_intensity_function[pm][p-1].y)/(energy_intensity_function[pm][p].x-energy_intensity_function[pm][p-1].x);
-float static_energy_intensity[pm in physical_machines] = energy_intensity_function[pm][1].y; 
+float slopeBeforePoint[t in pm_types][p in 1..nb_points]=
+  (p == 1) ? 0 : (energy_intensity_function[t][p].y - energy_intensity_function[t][p-1].y)/(energy_intensity_function[t][p].x-energy_intensity_function[t][p-1].x);
+float static_energy_intensity[pm in physical_machines] = energy_intensity_function[pm.type][1].y; 
 pwlFunction dynamic_energy_intensity[pm in physical_machines] = 
-  piecewise (p in 1..nb_points){slopeBeforePoint[pm][p] -> energy_intensity_function[pm][p].x; slopeBeforePoint[pm][nb_points]} (0, 0); 
+  piecewise (p in 1..nb_points){slopeBeforePoint[pm.type][p] -> energy_intensity_function[pm.type][p].x; slopeBeforePoint[pm.type][nb_points]} (0, 0); 
 
 // Weights
 Price price = ...;
@@ -92,14 +104,19 @@ float PUE = ...;
 float w_load_cpu = ...;
 
 float revenue[vm in virtual_machines] = (vm.requested.cpu * price.cpu + vm.requested.memory * price.memory); // Revenue per second from running a Virtual Machine
+float residual_revenue[pm in physical_machines] = (residual[pm].requested.cpu * price.cpu + residual[pm].requested.memory * price.memory);
 
 float epgap = ...;
+float time_limit = ...;
 
 // Set parameters
 execute
 {
   cplex.epgap=epgap;
   cplex.workmem=16384;
+  if (time_limit > 0) {
+    cplex.tilim=time_limit;
+  }
 } 
 
 // Decision Variables
@@ -113,10 +130,10 @@ dvar boolean is_migrating_from[virtual_machines][physical_machines];
 dvar boolean has_to_be_on[physical_machines];
 
 // Expressions
-dexpr float cpu_load[pm in physical_machines] = (1 / pm.capacity.cpu) * sum(vm in virtual_machines) vm.requested.cpu * new_allocation[vm][pm];
-dexpr float memory_load[pm in physical_machines] = (1 / pm.capacity.memory) * sum(vm in virtual_machines) vm.requested.memory * new_allocation[vm][pm]; 
-dexpr float cpu_load_migration[pm in physical_machines] = (1 / pm.capacity.cpu) * sum(vm in virtual_machines) vm.requested.cpu * (new_allocation[vm][pm] + is_migrating_from[vm][pm] - is_allocating_on[vm][pm] * (1 - was_allocating[vm])); // When there is a migration, allow pre-allocation of VMs
-dexpr float memory_load_migration[pm in physical_machines] = (1 / pm.capacity.memory) * sum(vm in virtual_machines) vm.requested.memory * (new_allocation[vm][pm] + is_migrating_from[vm][pm] - is_allocating_on[vm][pm] * (1 - was_allocating[vm])); 
+dexpr float cpu_load[pm in physical_machines] = (1 / pm.capacity.cpu) * (residual[pm].requested.cpu + sum(vm in virtual_machines) vm.requested.cpu * new_allocation[vm][pm]);
+dexpr float memory_load[pm in physical_machines] = (1 / pm.capacity.memory) * (residual[pm].requested.memory + sum(vm in virtual_machines) vm.requested.memory * new_allocation[vm][pm]); 
+dexpr float cpu_load_migration[pm in physical_machines] = (1 / pm.capacity.cpu) * residual[pm].requested.cpu + (1 / pm.capacity.cpu) * sum(vm in virtual_machines) vm.requested.cpu * (new_allocation[vm][pm] + is_migrating_from[vm][pm] - is_allocating_on[vm][pm] * (1 - was_allocating[vm])); // When there is a migration, allow pre-allocation of VMs
+dexpr float memory_load_migration[pm in physical_machines] = (1 / pm.capacity.memory) * residual[pm].requested.memory + (1 / pm.capacity.memory) * sum(vm in virtual_machines) vm.requested.memory * (new_allocation[vm][pm] + is_migrating_from[vm][pm] - is_allocating_on[vm][pm] * (1 - was_allocating[vm])); 
 
 dexpr int is_added[vm in virtual_machines] = (1 - sum(pm in physical_machines) old_allocation[vm][pm]) * sum(pm in physical_machines) new_allocation[vm][pm];
 
@@ -135,12 +152,14 @@ maximize    sum(pm in physical_machines) (
 		            ) 
 		        )
 		      + sum (vm in virtual_machines) new_allocation[vm][pm] * revenue[vm]
+		      + residual_revenue[pm]
 		    )
 		    // migration penalties
 		   - sum (vm in virtual_machines) is_migration[vm] * (
 			     vm.migration.energy * PUE * price.energy     // energy costs
 			   + revenue[vm] * vm.migration.down_time        // time costs
 			 ) / remaining_run_time[vm]
+		   - fixed_migration_penalty
 		  ;
 		  
 subject to {     
@@ -151,6 +170,7 @@ subject to {
   // If Virtual Machines are allocated to a PM, the PM cannot be turned off 
   forall(pm in physical_machines) {
     M * has_to_be_on[pm] >= sum(vm in virtual_machines) new_allocation[vm][pm];
+    has_to_be_on[pm] >= (residual[pm].count > 0 ? 1 : 0);
   }
   // Physical Machine CPU and Memory capacity
   forall(pm in physical_machines) {
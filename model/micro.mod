@@ -1,19 +1,4 @@
 // Tuple definitions
-tuple Execution {
-  float current_time;
-  float total_time;
-  float pm;
-}
-
-tuple Migration {
-  float current_time;
-  float total_time;
-  float down_time;
-  float from_pm;
-  float to_pm;
-  float energy;
-}
-
 tuple ArchitectureInt {
   int cpu;
   int memory;
@@ -38,12 +23,11 @@ tuple PhysicalMachine {
   int type;
 };
 
-tuple VirtualMachine {
+// Virtual Machines with the same requested resources, aggregated into one class
+tuple VirtualMachineClass {
   key int id;
   ArchitectureInt requested;
-  Execution allocation;
-  Execution run;
-  Migration migration;
+  int count;
 };
 
 tuple Price {
@@ -57,11 +41,27 @@ tuple Point {
   float y;
 }
 
+tuple PhysicalMachinePair {
+  int first;
+  int second;
+}
+
+// Virtual Machine class that may be allocated to a Physical Machine, at most count VMs
+tuple Assignment {
+  int vm;
+  int pm;
+  int count;
+}
+
 // Data
 {PhysicalMachine} physical_machines = ...;
-{VirtualMachine} virtual_machines= ...;
+{VirtualMachineClass} virtual_machines= ...;
 int nb_points = ...;
-Point energy_intensity_function[pm in physical_machines][1..nb_points]= ...;
+{int} pm_types = ...;
+Point energy_intensity_function[pm_types][1..nb_points]= ...;
+{PhysicalMachinePair} symmetric_pms = ...;
+{Assignment} assignments = ...;
+float allocation_init[assignments] = ...;
 
 // Weights
 Price price = ...;
@@ -69,43 +69,56 @@ float PUE = ...;
 float w_load_cpu = ...;
 
 float epgap = ...;
+float time_limit = ...;
 
 
 execute {
   cplex.epgap=epgap;
   cplex.workmem=16384;
+  if (time_limit > 0) {
+    cplex.tilim=time_limit;
+  }
 }
 
 // Energy consumption of each Physical Machine, depending by the load
-float slopeBeforePoint[pm in physical_machines][p in 1..nb_points]=
-  (p == 1) ? 0 : (energy_intensity_function[pm][p].y - energy_intensity_function[pm][p-1].y)/(energy_intensity_function[pm][p].x-energy_intensity_function[pm][p-1].x);
-float static_energy[pm in physical_machines] = energy_intensity_function[pm][1].y; 
+float slopeBeforePoint[t in pm_types][p in 1..nb_points]=
+  (p == 1) ? 0 : (energy_intensity_function[t][p].y - energy_intensity_function[t][p-1].y)/(energy_intensity_function[t][p].x-energy_intensity_function[t][p-1].x);
+float static_energy[pm in physical_machines] = energy_intensity_function[pm.type][1].y; 
 pwlFunction dynamic_energy[pm in physical_machines] = 
-  piecewise (p in 1..nb_points){slopeBeforePoint[pm][p] -> energy_intensity_function[pm][p].x; 0} (0, 0);
+  piecewise (p in 1..nb_points){slopeBeforePoint[pm.type][p] -> energy_intensity_function[pm.type][p].x; 0} (0, 0);
+
+// Allowed assignments of each Virtual Machine class and of each Physical Machine
+{Assignment} assignments_of_vm[vm in virtual_machines] = {a | a in assignments: a.vm == vm.id};
+{Assignment} assignments_on_pm[pm in physical_machines] = {a | a in assignments: a.pm == pm.id};
+ArchitectureInt assignment_requested[a in assignments] = item(virtual_machines, <a.vm>).requested;
+
+// Initial Solutions
+float is_on_init[pm in physical_machines] =
+  (pm.s.load.cpu > 0 || pm.s.load.memory > 0 || sum(a in assignments_on_pm[pm]) allocation_init[a] > 0) ? 1 : 0;
 
 // Decision Variables
-dvar boolean allocation[virtual_machines][physical_machines];
+dvar int allocation[a in assignments] in 0..a.count;
 dvar boolean is_on[physical_machines];
 
 // Expressions
-dexpr float cpu_load[pm in physical_machines] = pm.s.load.cpu + (1 / pm.capacity.cpu) * sum(vm in virtual_machines) vm.requested.cpu * allocation[vm][pm];
-dexpr float memory_load[pm in physical_machines] = pm.s.load.memory + (1 / pm.capacity.memory) * sum(vm in virtual_machines) vm.requested.memory * allocation[vm][pm]; 
+dexpr float cpu_load[pm in physical_machines] = pm.s.load.cpu + (1 / pm.capacity.cpu) * sum(a in assignments_on_pm[pm]) assignment_requested[a].cpu * allocation[a];
+dexpr float memory_load[pm in physical_machines] = pm.s.load.memory + (1 / pm.capacity.memory) * sum(a in assignments_on_pm[pm]) assignment_requested[a].memory * allocation[a]; 
 dexpr float additional_energy[pm in physical_machines] = 
     dynamic_energy[pm](w_load_cpu * cpu_load[pm] + (1 - w_load_cpu) * memory_load[pm])
   - dynamic_energy[pm](w_load_cpu * pm.s.load.cpu + (1 - w_load_cpu) * pm.s.load.memory);
   
-float revenue[vm in virtual_machines] = (vm.requested.cpu * price.cpu + vm.requested.memory * price.memory);                   
+float revenue[a in assignments] = (assignment_requested[a].cpu * price.cpu + assignment_requested[a].memory * price.memory);                   
 
 // Objective Function
 maximize   sum(pm in physical_machines) ( 
 	         - PUE * price.energy * (is_on[pm] * static_energy[pm] + additional_energy[pm])
-		     + sum (vm in virtual_machines) allocation[vm][pm] * revenue[vm]
+		     + sum (a in assignments_on_pm[pm]) allocation[a] * revenue[a]
 		   );
 	   
 subject to {
   // A Virtual Machine is assigned maximum to one Physical Machine
   forall (vm in virtual_machines) {
-    sum (pm in physical_machines) allocation[vm][pm] <= 1;
+    sum (a in assignments_of_vm[vm]) allocation[a] <= vm.count;
   } 
   // Physical Machine CPU and Memory capacity
   forall(pm in physical_machines) {
@@ -117,4 +130,10 @@ subject to {
     is_on[pm] >= cpu_load[pm];
     is_on[pm] >= memory_load[pm];
   }
+  // Symmetry breaking: interchangeable Physical Machines are turned on and loaded in order
+  forall(p in symmetric_pms) {
+    is_on[item(physical_machines, <p.first>)] >= is_on[item(physical_machines, <p.second>)];
+    w_load_cpu * cpu_load[item(physical_machines, <p.first>)] + (1 - w_load_cpu) * memory_load[item(physical_machines, <p.first>)]
+      >= w_load_cpu * cpu_load[item(physical_machines, <p.second>)] + (1 - w_load_cpu) * memory_load[item(physical_machines, <p.second>)];
+  }
 }    
\ No newline at end of file
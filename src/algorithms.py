@@ -1,8 +1,22 @@
-from copy import deepcopy
 from math import sqrt
 
-from utils import evaluate_piecewise_linear_function
-from weights import price, pue, w_load_cpu
+import numpy as np
+
+from placement import (
+    build_indexed_heap,
+    build_placement_index,
+    find_best_fit,
+    find_first_fit,
+    iterate_indexed_heap,
+    place_vm,
+    update_indexed_heap,
+    vm_fits_on_pm,
+)
+from utils import (
+    evaluate_piecewise_linear_function,
+    evaluate_piecewise_linear_function_array,
+)
+from weights import EPSILON, price, pue, w_load_cpu
 
 try:
     profile  # type: ignore
@@ -12,28 +26,6 @@ except NameError:
         return func
 
 
-def vm_fits_on_pm(vm, pm):
-    if (
-        pm["capacity"]["cpu"]
-        - (pm["s"]["load"]["cpu"] * pm["capacity"]["cpu"] + vm["requested"]["cpu"])
-        >= 0
-        and pm["capacity"]["memory"]
-        - (
-            pm["s"]["load"]["memory"] * pm["capacity"]["memory"]
-            + vm["requested"]["memory"]
-        )
-        >= 0
-        and not (pm["s"]["state"] == 0 and pm["s"]["time_to_turn_off"] > 0)
-    ):
-        if (
-            vm["allocation"]["pm"] == -1
-            and vm["migration"]["to_pm"] == -1
-            and vm["run"]["pm"] != pm["id"]
-        ):
-            return True
-    return False
-
-
 def vm_exceeds_pm_load(vm, pm):
     return (
         pm["capacity"]["cpu"]
@@ -109,19 +101,18 @@ def first_fit(vms, pms):
     allocation = {vm_id: {"vm_id": vm_id, "pm_id": None} for vm_id in vms}
     sorted_pms = sorted(pms.values(), key=lambda pm: pm["s"]["state"], reverse=True)
 
+    index = build_placement_index(sorted_pms)
+
     for vm_id, vm in vms.items():
         if vm["allocation"]["pm"] != -1 or vm["migration"]["to_pm"] != -1:
             continue  # VM is already allocated or migrating
-        for pm in sorted_pms:
-            if vm["run"]["pm"] == pm["id"]:
-                break  # VM is already running on the best PM
-            if vm_fits_on_pm(vm, pm):
-                pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
-                pm["s"]["load"]["memory"] += (
-                    vm["requested"]["memory"] / pm["capacity"]["memory"]
-                )
-                allocation[vm_id]["pm_id"] = pm["id"]
-                break  # Move to next VM
+        # Only PMs before the one the VM is running on are better
+        position = find_first_fit(
+            index, vm, end=index["positions"].get(vm["run"]["pm"])
+        )
+        if position is not None:
+            pm = place_vm(index, vm, position)
+            allocation[vm_id]["pm_id"] = pm["id"]
 
     algorithms_reallocate_vms(allocation.values(), vms)
     is_on = manage_pms_allocation(pms, allocation.values())
@@ -130,6 +121,7 @@ def first_fit(vms, pms):
 
 def best_fit(vms, pms):
     allocation = {vm_id: {"vm_id": vm_id, "pm_id": None} for vm_id in vms}
+    # Initial load order keeps the subtrees of the index coherent for pruning
     sorted_pms = sorted(
         pms.values(),
         key=lambda pm: (
@@ -138,43 +130,46 @@ def best_fit(vms, pms):
         ),
         reverse=True,
     )
+    index = build_placement_index(sorted_pms, track_load=True)
 
     for vm_id, vm in vms.items():
         if vm["allocation"]["pm"] != -1 or vm["migration"]["to_pm"] != -1:
             continue  # VM is already allocated or migrating
-        for pm in sorted_pms:
-            if vm["run"]["pm"] == pm["id"]:
-                break  # VM is already running on the best PM
-            if vm_fits_on_pm(vm, pm):
-                pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
-                pm["s"]["load"]["memory"] += (
-                    vm["requested"]["memory"] / pm["capacity"]["memory"]
-                )
-                allocation[vm_id]["pm_id"] = pm["id"]
-                break  # Move to next VM
+        # Most loaded PM with room, re-keyed after every placement
+        position = find_best_fit(index, vm)
+        if position is not None:
+            pm = place_vm(index, vm, position)
+            allocation[vm_id]["pm_id"] = pm["id"]
 
     algorithms_reallocate_vms(allocation.values(), vms)
     is_on = manage_pms_allocation(pms, allocation.values())
     return is_on
 
 
-def get_sort_key_pm(pm, vms, sort_key):
+def get_occupied_resources(vms, pms):
+    # Resources requested by the VMs allocated to or running on each PM
+    occupied = {pm_id: {"cpu": 0, "memory": 0, "magnitude": 0} for pm_id in pms}
+    for vm in vms.values():
+        for pm_id in {vm["allocation"]["pm"], vm["run"]["pm"]}:
+            if pm_id in occupied:
+                occupied[pm_id]["cpu"] += vm["requested"]["cpu"]
+                occupied[pm_id]["memory"] += vm["requested"]["memory"]
+                occupied[pm_id]["magnitude"] += get_magnitude_vm(vm)
+    return occupied
+
+
+def get_sort_key_pm(pm, occupied, sort_key):
     if sort_key == "OccupiedMagnitude":
-        load_w_load_cpu = 0
-        memory_load = 0
-        for vm in vms.values():
-            if vm["allocation"]["pm"] == pm["id"] or vm["run"]["pm"] == pm["id"]:
-                load_w_load_cpu += vm["requested"]["cpu"]
-                memory_load += vm["requested"]["memory"]
-        return sqrt(load_w_load_cpu**2 + memory_load**2)
+        return sqrt(occupied["cpu"] ** 2 + occupied["memory"] ** 2)
     elif sort_key == "AbsoluteCapacity":
         return get_magnitude_pm(pm)
     elif sort_key == "PercentageUtil":
-        total_vm_magnitude = 0
-        for vm in vms.values():
-            if vm["allocation"]["pm"] == pm["id"] or vm["run"]["pm"] == pm["id"]:
-                total_vm_magnitude += get_magnitude_vm(vm)
-        return total_vm_magnitude / get_magnitude_pm(pm)
+        return occupied["magnitude"] / get_magnitude_pm(pm)
+
+
+def get_shi_rank(pm, occupied, sort_key, position):
+    # Highest sort key first, PM order on ties
+    return (-get_sort_key_pm(pm, occupied, sort_key), position)
 
 
 def get_magnitude_pm(pm):
@@ -201,6 +196,34 @@ def get_vms_on_pm_list(vms, pms, is_on):
     return vms_on_pm
 
 
+def journaled_set(journal, container, key, value):
+    journal.append(("set", container, key, container[key]))
+    container[key] = value
+
+
+def journaled_remove(journal, items, item):
+    index = items.index(item)
+    journal.append(("remove", items, index, item))
+    del items[index]
+
+
+def journaled_append(journal, items, item):
+    journal.append(("append", items, None, item))
+    items.append(item)
+
+
+def rollback(journal):
+    # Undo the journaled mutations in reverse order
+    while journal:
+        operation, container, key, value = journal.pop()
+        if operation == "set":
+            container[key] = value
+        elif operation == "remove":
+            container.insert(key, value)
+        else:
+            container.pop()
+
+
 def shi_migration(
     vms, physical_machines, time_step, sort_key, failed_migrations_limit=10
 ):
@@ -215,60 +238,81 @@ def shi_migration(
     is_on = {pm_id: 0 for pm_id in pms}
 
     vms_on_pm = get_vms_on_pm_list(vms, pms, is_on)
-    magnitude_pm = {}
+    occupied = get_occupied_resources(vms, pms)
+    positions = {pm_id: position for position, pm_id in enumerate(pms)}
     magnitude_vm = {vm_id: get_magnitude_vm(vm) for vm_id, vm in vms.items()}
     failed_migrations = 0
 
-    for pm_id, pm in pms.items():
-        magnitude_pm[pm_id] = get_sort_key_pm(pm, vms, sort_key)
-    sorted_pms = sorted(
-        pms.values(), key=lambda pm: magnitude_pm[pm["id"]], reverse=True
+    ordered_pms = build_indexed_heap(
+        {
+            pm_id: get_shi_rank(pm, occupied[pm_id], sort_key, positions[pm_id])
+            for pm_id, pm in pms.items()
+        }
     )
 
-    for pm in reversed(sorted_pms):
-        # Backup VMs and PMs
-        vms_copy = deepcopy(vms)
-        pms_copy = deepcopy(pms)
-        vms_on_pm[pm["id"]].sort(key=lambda vm: magnitude_vm[vm["id"]], reverse=True)
+    for pm_id in reversed(list(iterate_indexed_heap(ordered_pms))):
+        pm = pms[pm_id]
+        # Journal of the mutations made while evacuating this PM
+        journal = []
+        vms_on_pm[pm_id].sort(key=lambda vm: magnitude_vm[vm["id"]], reverse=True)
 
-        for vm in vms_on_pm[pm["id"]]:
+        for vm in vms_on_pm[pm_id]:
             if vm["allocation"]["pm"] != -1 or vm["migration"]["to_pm"] != -1:
                 continue
-            for pm_candidate in sorted_pms:
-                if pm_candidate["id"] == pm["id"]:
+            pm_candidate = None
+            for candidate_id in iterate_indexed_heap(ordered_pms):
+                if candidate_id == pm_id:
                     break
-                if (
-                    pm_candidate["s"]["state"] == 0
-                    or pm_candidate["s"]["time_to_turn_on"] > 0
-                ):
+                candidate = pms[candidate_id]
+                if candidate["s"]["state"] == 0 or candidate["s"]["time_to_turn_on"] > 0:
                     continue
-                if vm_fits_on_pm(vm, pm_candidate):
-                    vm["migration"]["from_pm"] = vm["run"]["pm"]
-                    vm["migration"]["to_pm"] = pm_candidate["id"]
-                    pm_candidate["s"]["load"]["cpu"] += (
-                        vm["requested"]["cpu"] / pm_candidate["capacity"]["cpu"]
-                    )
-                    pm_candidate["s"]["load"]["memory"] += (
-                        vm["requested"]["memory"] / pm_candidate["capacity"]["memory"]
-                    )
-                    vms_on_pm[vm["run"]["pm"]].remove(vm)
-                    vm["run"]["pm"] = -1
-                    magnitude_pm[pm["id"]] = get_sort_key_pm(pm, vms, sort_key)
-
-                    vms_on_pm[pm_candidate["id"]].append(vm)
-                    magnitude_pm[pm_candidate["id"]] = get_sort_key_pm(
-                        pm_candidate, vms, sort_key
-                    )
-                    sorted_pms.sort(key=lambda pm: magnitude_pm[pm["id"]], reverse=True)
+                if vm_fits_on_pm(vm, candidate):
+                    pm_candidate = candidate
                     break
+            if pm_candidate is None:
+                continue
 
-        if vms_on_pm[pm["id"]]:
-            vms = deepcopy(vms_copy)
-            pms = deepcopy(pms_copy)
-            vms_on_pm = get_vms_on_pm_list(vms, pms, is_on)
-            magnitude_pm[pm["id"]] = get_sort_key_pm(pm, vms, sort_key)
-            sorted_pms = sorted(
-                pms.values(), key=lambda pm: magnitude_pm[pm["id"]], reverse=True
+            load = pm_candidate["s"]["load"]
+            journaled_set(journal, vm["migration"], "from_pm", vm["run"]["pm"])
+            journaled_set(journal, vm["migration"], "to_pm", pm_candidate["id"])
+            journaled_set(
+                journal,
+                load,
+                "cpu",
+                load["cpu"] + vm["requested"]["cpu"] / pm_candidate["capacity"]["cpu"],
+            )
+            journaled_set(
+                journal,
+                load,
+                "memory",
+                load["memory"]
+                + vm["requested"]["memory"] / pm_candidate["capacity"]["memory"],
+            )
+            journaled_remove(journal, vms_on_pm[vm["run"]["pm"]], vm)
+            journaled_set(journal, vm["run"], "pm", -1)
+            journaled_append(journal, vms_on_pm[pm_candidate["id"]], vm)
+
+            # A migrating VM is counted on no PM, so only the source PM is re-ranked
+            for resource, amount in (
+                ("cpu", vm["requested"]["cpu"]),
+                ("memory", vm["requested"]["memory"]),
+                ("magnitude", magnitude_vm[vm["id"]]),
+            ):
+                journaled_set(
+                    journal, occupied[pm_id], resource, occupied[pm_id][resource] - amount
+                )
+            update_indexed_heap(
+                ordered_pms,
+                pm_id,
+                get_shi_rank(pm, occupied[pm_id], sort_key, positions[pm_id]),
+            )
+
+        if vms_on_pm[pm_id]:
+            rollback(journal)
+            update_indexed_heap(
+                ordered_pms,
+                pm_id,
+                get_shi_rank(pm, occupied[pm_id], sort_key, positions[pm_id]),
             )
             failed_migrations += 1
 
@@ -281,23 +325,38 @@ def shi_migration(
 
 
 def shi_allocation(vms, pms, sort_key):
-    magnitude_pm = {}
-    for pm_id, pm in pms.items():
-        magnitude_pm[pm_id] = get_sort_key_pm(pm, vms, sort_key)
+    occupied = get_occupied_resources(vms, pms)
+    positions = {pm_id: position for position, pm_id in enumerate(pms)}
+    ordered_pms = build_indexed_heap(
+        {
+            pm_id: get_shi_rank(pm, occupied[pm_id], sort_key, positions[pm_id])
+            for pm_id, pm in pms.items()
+        }
+    )
 
     for vm in vms.values():
-        sorted_pms = sorted(
-            pms.values(), key=lambda pm: magnitude_pm[pm["id"]], reverse=True
+        pm_id = next(
+            (
+                pm_id
+                for pm_id in iterate_indexed_heap(ordered_pms)
+                if vm_fits_on_pm(vm, pms[pm_id])
+            ),
+            None,
+        )
+        if pm_id is None:
+            continue
+        pm = pms[pm_id]
+        vm["allocation"]["pm"] = pm_id
+        pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
+        pm["s"]["load"]["memory"] += vm["requested"]["memory"] / pm["capacity"]["memory"]
+        occupied[pm_id]["cpu"] += vm["requested"]["cpu"]
+        occupied[pm_id]["memory"] += vm["requested"]["memory"]
+        occupied[pm_id]["magnitude"] += get_magnitude_vm(vm)
+        update_indexed_heap(
+            ordered_pms,
+            pm_id,
+            get_shi_rank(pm, occupied[pm_id], sort_key, positions[pm_id]),
         )
-        for pm in sorted_pms:
-            if vm_fits_on_pm(vm, pm):
-                vm["allocation"]["pm"] = pm["id"]
-                pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
-                pm["s"]["load"]["memory"] += (
-                    vm["requested"]["memory"] / pm["capacity"]["memory"]
-                )
-                magnitude_pm[pm["id"]] = get_sort_key_pm(pm, vms, sort_key)
-                break
 
     allocation = [
         {"vm_id": vm_id, "pm_id": vm["allocation"]["pm"]} for vm_id, vm in vms.items()
@@ -319,19 +378,18 @@ def lago(vms, pms, power_function_database):
         reverse=True,
     )
 
+    index = build_placement_index(sorted_pms)
+
     for vm_id, vm in vms.items():
         if vm["allocation"]["pm"] != -1 or vm["migration"]["to_pm"] != -1:
             continue  # VM is already allocated or migrating
-        for pm in sorted_pms:
-            if vm["run"]["pm"] == pm["id"]:
-                break  # VM is already running on the best PM
-            if vm_fits_on_pm(vm, pm):
-                pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
-                pm["s"]["load"]["memory"] += (
-                    vm["requested"]["memory"] / pm["capacity"]["memory"]
-                )
-                allocation[vm_id]["pm_id"] = pm["id"]
-                break  # Move to next VM
+        # Only PMs before the one the VM is running on are better
+        position = find_first_fit(
+            index, vm, end=index["positions"].get(vm["run"]["pm"])
+        )
+        if position is not None:
+            pm = place_vm(index, vm, position)
+            allocation[vm_id]["pm_id"] = pm["id"]
 
     algorithms_reallocate_vms(allocation.values(), vms)
     is_on = manage_pms_allocation(pms, allocation.values())
@@ -349,18 +407,61 @@ def backup_allocation(non_allocated_vms, pms, idle_power):
         reverse=True,
     )
 
+    index = build_placement_index(sorted_pms)
+
     for vm in non_allocated_vms.values():
-        for pm in sorted_pms:
-            if vm_fits_on_pm(vm, pm):
-                pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
-                pm["s"]["load"]["memory"] += (
-                    vm["requested"]["memory"] / pm["capacity"]["memory"]
-                )
-                vm["allocation"]["pm"] = pm["id"]
-                break  # Move to next VM
+        if vm["allocation"]["pm"] != -1 or vm["migration"]["to_pm"] != -1:
+            continue  # VM is already allocated or migrating
+        position = find_first_fit(index, vm)
+        if position is not None:
+            pm = place_vm(index, vm, position)
+            vm["allocation"]["pm"] = pm["id"]
+
+
+def get_load_balancer_improvements(
+    pm_mins, candidates, load_cost_before_max, load_cost_after_max, energy_intensity_database
+):
+    # For each destination (row) and candidate VM (column), whether the VM fits and its migration increases the gain
+    capacity_cpu = np.array([[pm["capacity"]["cpu"]] for pm in pm_mins], dtype=float)
+    capacity_memory = np.array(
+        [[pm["capacity"]["memory"]] for pm in pm_mins], dtype=float
+    )
+    load_cpu = np.array([[pm["s"]["load"]["cpu"]] for pm in pm_mins], dtype=float)
+    load_memory = np.array([[pm["s"]["load"]["memory"]] for pm in pm_mins], dtype=float)
+    pm_types = np.array([pm["type"] for pm in pm_mins])
+
+    fits = (capacity_cpu - (load_cpu * capacity_cpu + candidates["cpu"]) >= 0) & (
+        capacity_memory - (load_memory * capacity_memory + candidates["memory"]) >= 0
+    )
+
+    load_before_min = w_load_cpu * load_cpu + (1 - w_load_cpu) * load_memory
+    load_after_min = w_load_cpu * (load_cpu + candidates["cpu"] / capacity_cpu) + (
+        1 - w_load_cpu
+    ) * (load_memory + candidates["memory"] / capacity_memory)
+    energy_intensity_before_min = np.empty_like(load_before_min)
+    energy_intensity_after_min = np.empty_like(load_after_min)
+    for pm_type in np.unique(pm_types):
+        rows = pm_types == pm_type
+        energy_intensity_before_min[rows] = evaluate_piecewise_linear_function_array(
+            energy_intensity_database[pm_type], load_before_min[rows]
+        )
+        energy_intensity_after_min[rows] = evaluate_piecewise_linear_function_array(
+            energy_intensity_database[pm_type], load_after_min[rows]
+        )
+    load_cost_before_min = pue * price["energy"] * energy_intensity_before_min
+    load_cost_after_min = pue * price["energy"] * energy_intensity_after_min
+
+    remaining_run_time = candidates["remaining_run_time"]
+    costs_before = (load_cost_before_max + load_cost_before_min) * remaining_run_time
+    costs_after = (load_cost_after_max + load_cost_after_min) * (
+        remaining_run_time + candidates["down_time"]
+    ) + candidates["migration_energy_cost"]
+    gain_before = candidates["revenue_per_second"] * remaining_run_time - costs_before
+    gain_after = candidates["revenue_per_second"] * remaining_run_time - costs_after
+    return fits & (gain_after > gain_before)
 
 
-def load_balancer(vms, pm_max, pm_min, energy_intensity_database):
+def load_balancer(vms, pm_max, pm_mins, energy_intensity_database):
     vms.sort(
         key=lambda vm: (
             w_load_cpu * vm["requested"]["cpu"]
@@ -369,85 +470,116 @@ def load_balancer(vms, pm_max, pm_min, energy_intensity_database):
         reverse=True,
     )
 
-    for vm in vms:
-        remaining_run_time = vm["run"]["total_time"] - vm["run"]["current_time"]
-        revenue_per_second = vm["revenue"] / vm["run"]["total_time"]
-        if (
-            vm["run"]["pm"] == -1
-            or vm["migration"]["total_time"] > remaining_run_time
-            or vm_exceeds_pm_load(vm, pm_min)
-        ):
-            continue
-        load_before_max = (
-            w_load_cpu * pm_max["s"]["load"]["cpu"]
-            + (1 - w_load_cpu) * pm_max["s"]["load"]["memory"]
-        )
-        load_before_min = (
-            w_load_cpu * pm_min["s"]["load"]["cpu"]
-            + (1 - w_load_cpu) * pm_min["s"]["load"]["memory"]
-        )
-        load_after_max = w_load_cpu * (
-            pm_max["s"]["load"]["cpu"]
-            - vm["requested"]["cpu"] / pm_max["capacity"]["cpu"]
-        ) + (1 - w_load_cpu) * (
-            pm_max["s"]["load"]["memory"]
-            - vm["requested"]["memory"] / pm_max["capacity"]["memory"]
-        )
-        load_after_min = w_load_cpu * (
-            pm_min["s"]["load"]["cpu"]
-            + vm["requested"]["cpu"] / pm_min["capacity"]["cpu"]
-        ) + (1 - w_load_cpu) * (
-            pm_min["s"]["load"]["memory"]
-            + vm["requested"]["memory"] / pm_min["capacity"]["memory"]
-        )
-        migration_energy_cost = pue * price["energy"] * vm["migration"]["energy"]
-        load_cost_before_max = (
-            pue
-            * price["energy"]
-            * evaluate_piecewise_linear_function(
-                energy_intensity_database[pm_max["type"]], load_before_max
-            )
-        )
-        load_cost_before_min = (
-            pue
-            * price["energy"]
-            * evaluate_piecewise_linear_function(
-                energy_intensity_database[pm_min["type"]], load_before_min
-            )
+    # Running VMs that can complete a migration before they end
+    candidate_vms = [
+        vm
+        for vm in vms
+        if vm["run"]["pm"] != -1
+        and vm["migration"]["total_time"]
+        <= vm["run"]["total_time"] - vm["run"]["current_time"]
+    ]
+    if not candidate_vms:
+        return
+
+    candidates = {
+        "cpu": np.array([vm["requested"]["cpu"] for vm in candidate_vms], dtype=float),
+        "memory": np.array(
+            [vm["requested"]["memory"] for vm in candidate_vms], dtype=float
+        ),
+        "remaining_run_time": np.array(
+            [vm["run"]["total_time"] - vm["run"]["current_time"] for vm in candidate_vms]
+        ),
+        "revenue_per_second": np.array(
+            [vm["revenue"] / vm["run"]["total_time"] for vm in candidate_vms]
+        ),
+        "down_time": np.array(
+            [vm["migration"]["down_time"] for vm in candidate_vms], dtype=float
+        ),
+        "migration_energy_cost": np.array(
+            [pue * price["energy"] * vm["migration"]["energy"] for vm in candidate_vms]
+        ),
+    }
+
+    # The load of pm_max is not updated when its VMs leave, so its costs are fixed
+    load_before_max = (
+        w_load_cpu * pm_max["s"]["load"]["cpu"]
+        + (1 - w_load_cpu) * pm_max["s"]["load"]["memory"]
+    )
+    load_after_max = w_load_cpu * (
+        pm_max["s"]["load"]["cpu"] - candidates["cpu"] / pm_max["capacity"]["cpu"]
+    ) + (1 - w_load_cpu) * (
+        pm_max["s"]["load"]["memory"]
+        - candidates["memory"] / pm_max["capacity"]["memory"]
+    )
+    load_cost_before_max = (
+        pue
+        * price["energy"]
+        * evaluate_piecewise_linear_function(
+            energy_intensity_database[pm_max["type"]], load_before_max
         )
-        load_cost_after_max = (
-            pue
-            * price["energy"]
-            * evaluate_piecewise_linear_function(
-                energy_intensity_database[pm_max["type"]], load_after_max
-            )
+    )
+    load_cost_after_max = (
+        pue
+        * price["energy"]
+        * evaluate_piecewise_linear_function_array(
+            energy_intensity_database[pm_max["type"]], load_after_max
         )
-        load_cost_after_min = (
-            pue
-            * price["energy"]
-            * evaluate_piecewise_linear_function(
-                energy_intensity_database[pm_min["type"]], load_after_min
+    )
+
+    # Skip destinations without room for the smallest candidate VM
+    min_cpu = candidates["cpu"].min() - EPSILON
+    min_memory = candidates["memory"].min() - EPSILON
+    pm_mins = [
+        pm_min
+        for pm_min in pm_mins
+        if pm_min["id"] != pm_max["id"]
+        and pm_min["capacity"]["cpu"] * (1 - pm_min["s"]["load"]["cpu"]) >= min_cpu
+        and pm_min["capacity"]["memory"] * (1 - pm_min["s"]["load"]["memory"])
+        >= min_memory
+    ]
+    if not pm_mins:
+        return
+
+    improvements = get_load_balancer_improvements(
+        pm_mins,
+        candidates,
+        load_cost_before_max,
+        load_cost_after_max,
+        energy_intensity_database,
+    )
+    available = np.ones(len(candidate_vms), dtype=bool)
+
+    # Destinations in order, the VMs of each one in order, as a sequential scan would
+    for pm_min, pm_min_improvements in zip(pm_mins, improvements):
+        first_index = 0
+        while True:
+            improving_indices = np.flatnonzero(
+                pm_min_improvements[first_index:] & available[first_index:]
             )
-        )
-        costs_before = (
-            load_cost_before_max + load_cost_before_min
-        ) * remaining_run_time
-        costs_after = (load_cost_after_max + load_cost_after_min) * (
-            remaining_run_time + vm["migration"]["down_time"]
-        ) + migration_energy_cost
-        gain_before = revenue_per_second * remaining_run_time - costs_before
-        gain_after = revenue_per_second * remaining_run_time - costs_after
-        if gain_after > gain_before:
-            if vm["run"]["pm"] != -1:
-                vm["migration"]["from_pm"] = pm_max["id"]
-                vm["migration"]["to_pm"] = pm_min["id"]
-                vm["run"]["pm"] = -1
-            elif vm["allocation"]["pm"] != -1:
-                vm["allocation"]["pm"] = pm_min["id"]
+            if len(improving_indices) == 0:
+                break
 
+            # Commit the first improving VM and rescore the others on the new load
+            vm_index = first_index + improving_indices[0]
+            vm = candidate_vms[vm_index]
+            vm["migration"]["from_pm"] = pm_max["id"]
+            vm["migration"]["to_pm"] = pm_min["id"]
+            vm["run"]["pm"] = -1
             pm_min["s"]["load"]["cpu"] += (
                 vm["requested"]["cpu"] / pm_min["capacity"]["cpu"]
             )
             pm_min["s"]["load"]["memory"] += (
                 vm["requested"]["memory"] / pm_min["capacity"]["memory"]
             )
+            available[vm_index] = False
+            first_index = vm_index + 1
+            pm_min_improvements = get_load_balancer_improvements(
+                [pm_min],
+                candidates,
+                load_cost_before_max,
+                load_cost_after_max,
+                energy_intensity_database,
+            )[0]
+
+        if not available.any():
+            return
@@ -3,8 +3,10 @@ import shutil
 import subprocess
 from copy import deepcopy
 
+from artifacts import copy_model_artifact, release_model_artifacts, write_model_artifact
 from calculate import calculate_load
-from config import FLOW_CONTROL_PATH
+from config import ANYTIME_BACKSTOP_TIME, ANYTIME_SOLVING, FLOW_CONTROL_PATH
+from utils import get_opl_return_code, is_opl_output_valid
 
 try:
     profile  # type: ignore
@@ -22,41 +24,58 @@ def run_opl_model(
     step,
     model_name,
     hard_time_limit=None,
+    data_folder_path=None,
 ):
-    os.makedirs(model_output_folder_path, exist_ok=True)
+    # Concurrent solves read their input files from their own folder
+    if data_folder_path is None:
+        data_folder_path = model_input_folder_path
+    elif data_folder_path != model_input_folder_path:
+        os.makedirs(data_folder_path, exist_ok=True)
+        shutil.copy(
+            os.path.join(model_input_folder_path, "weights.dat"),
+            os.path.join(data_folder_path, "weights.dat"),
+        )
 
     # Copy the input files to the required path
-    shutil.copy(
+    copy_model_artifact(
         vm_model_input_file_path,
-        os.path.join(model_input_folder_path, "virtual_machines.dat"),
+        os.path.join(data_folder_path, "virtual_machines.dat"),
     )
-    shutil.copy(
+    copy_model_artifact(
         pm_model_input_file_path,
-        os.path.join(model_input_folder_path, "physical_machines.dat"),
+        os.path.join(data_folder_path, "physical_machines.dat"),
     )
 
     cmd = [
         "oplrun",
         f"-Dmodel_name={model_name}",
+        f"-Ddata_folder={os.path.join(data_folder_path, '')}",
         os.path.expanduser(FLOW_CONTROL_PATH),
     ]
 
+    # With anytime solving the time limit is enforced by CPLEX, the timeout is only a backstop
+    timeout = hard_time_limit
+    if ANYTIME_SOLVING and hard_time_limit:
+        timeout = hard_time_limit + ANYTIME_BACKSTOP_TIME
+
     try:
         # Run the OPL model with a timeout
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=hard_time_limit
-        )
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
 
         # Save the OPL model output
         output_file_path = os.path.join(
             model_output_folder_path, f"opl_output_t{step}.txt"
         )
-        with open(output_file_path, "w") as file:
-            file.write(result.stdout)
+        write_model_artifact(output_file_path, result.stdout)
+        release_model_artifacts(
+            step,
+            not is_opl_output_valid(result.stdout, get_opl_return_code(result.stdout)),
+        )
 
         return result.stdout
 
     except subprocess.TimeoutExpired:
+        release_model_artifacts(step, True)
         return None
 
 
@@ -213,24 +232,22 @@ def get_non_allocated_vms(active_vms):
     }
 
 
-def get_non_allocated_workload(active_vms, scheduled_vms):
-    non_allocated_vms = {}
+def get_scheduled_vm_ids(scheduled_vms):
+    return {
+        scheduled_vm["id"]
+        for vm_list in scheduled_vms.values()
+        for scheduled_vm in vm_list
+    }
 
-    for vm in active_vms.values():
-        if (
-            vm["allocation"]["pm"] == -1
-            and vm["run"]["pm"] == -1
-            and vm["migration"]["from_pm"] == -1
-            and vm["migration"]["to_pm"] == -1
-            and not any(
-                vm["id"] == scheduled_vm["id"]
-                for vm_list in scheduled_vms.values()
-                for scheduled_vm in vm_list
-            )
-        ):
-            non_allocated_vms[vm["id"]] = vm
 
-    return non_allocated_vms
+def get_non_allocated_workload(active_vms, scheduled_vms):
+    scheduled_vm_ids = get_scheduled_vm_ids(scheduled_vms)
+
+    return {
+        vm_id: vm
+        for vm_id, vm in get_non_allocated_vms(active_vms).items()
+        if vm_id not in scheduled_vm_ids
+    }
 
 
 def get_pms_on_schedule(active_vms, scheduled_vms):
@@ -0,0 +1,88 @@
+import os
+import shutil
+import threading
+
+from config import (
+    MODEL_ARTIFACTS_IN_MEMORY,
+    MODEL_ARTIFACTS_LAST_STEPS,
+    MODEL_ARTIFACTS_RETENTION,
+)
+
+# Artifacts of the solve in progress in each thread, path -> content (None if already on disk)
+solve_artifacts = threading.local()
+
+# Artifacts kept on disk for the "last_steps" retention, step -> paths
+retained_artifacts = {}
+retained_artifacts_lock = threading.Lock()
+
+
+def get_pending_artifacts():
+    # Concurrent solves each stage and release their own artifacts
+    if not hasattr(solve_artifacts, "pending"):
+        solve_artifacts.pending = {}
+    return solve_artifacts.pending
+
+
+def write_model_artifact(file_path, content):
+    pending_artifacts = get_pending_artifacts()
+    if MODEL_ARTIFACTS_IN_MEMORY:
+        pending_artifacts[file_path] = content
+        return
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as file:
+        file.write(content)
+    pending_artifacts[file_path] = None
+
+
+def copy_model_artifact(file_path, destination_path):
+    content = get_pending_artifacts().get(file_path)
+    if content is None:
+        shutil.copy(file_path, destination_path)
+    else:
+        with open(destination_path, "w", encoding="utf-8") as file:
+            file.write(content)
+
+
+def remove_model_artifact(file_path):
+    try:
+        os.remove(file_path)
+        os.rmdir(os.path.dirname(file_path))  # Only succeeds once the folder is empty
+    except OSError:
+        pass
+
+
+def is_artifact_retained(failed):
+    if MODEL_ARTIFACTS_RETENTION == "failures":
+        return failed
+    return MODEL_ARTIFACTS_RETENTION in ("all", "last_steps")
+
+
+def release_model_artifacts(step, failed):
+    # Persist or discard the artifacts of the last solve according to the retention policy
+    retained = is_artifact_retained(failed)
+    pending_artifacts = get_pending_artifacts()
+
+    for file_path, content in pending_artifacts.items():
+        if not retained:
+            if content is None:
+                remove_model_artifact(file_path)
+            continue
+
+        if content is not None:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w", encoding="utf-8") as file:
+                file.write(content)
+
+        if MODEL_ARTIFACTS_RETENTION == "last_steps":
+            with retained_artifacts_lock:
+                retained_artifacts.setdefault(step, []).append(file_path)
+
+    pending_artifacts.clear()
+
+    # Drop the artifacts of steps that fell out of the retention window
+    with retained_artifacts_lock:
+        for old_step in list(retained_artifacts.keys()):
+            if old_step <= step - MODEL_ARTIFACTS_LAST_STEPS:
+                for file_path in retained_artifacts.pop(old_step):
+                    remove_model_artifact(file_path)
@@ -51,9 +51,21 @@ MACRO_MODEL_MAX_SUBSETS = 5
 MACRO_MODEL_MAX_PMS = 20
 MICRO_MODEL_MAX_PMS = 50
 MICRO_MODEL_MAX_VMS = 100
+MICRO_MODEL_PARALLEL_SOLVES = 1  # Micro subsets solved concurrently, each in its own OPL data folder
+MICRO_MODEL_SOLVER = "cplex"  # "cplex" (oplrun) or "highs" (scipy.optimize.milp, in memory)
+MICRO_BACKLOG_CONTROL = True  # Switch the micro phase to backup allocation during arrival surges
+MICRO_BACKLOG_HIGH = 4 * MICRO_MODEL_MAX_VMS  # Pending VMs above which the heuristic takes over
+MICRO_BACKLOG_LOW = MICRO_MODEL_MAX_VMS  # Pending VMs up to which the micro model is used again
+MICRO_BACKLOG_MIN_SUCCESS_RATE = 0.5  # Share of valid recent micro solves below which the heuristic takes over
+MICRO_BACKLOG_SUCCESS_WINDOW = 5  # Number of recent micro solves in the success rate
+MICRO_BACKLOG_MIN_HEURISTIC_RUNS = 3  # Micro phase runs on the heuristic before switching back
+MICRO_BACKLOG_ADMITTED_VMS = 2 * MICRO_MODEL_MAX_VMS  # Pending VMs given to the micro model per step, by revenue
 FAILED_MIGRATIONS_LIMIT = 5
 MIGRATION_MODEL_MAX_FRAGMENTED_PMS = 4 * FAILED_MIGRATIONS_LIMIT
+MIGRATION_MODEL_MAX_CANDIDATE_PMS = 20  # Destination PMs per migration solve, doubled on failure
+MIGRATION_MODEL_FAST_PATH = True  # Evacuate PMs greedily when first-fit decreasing succeeds
 PM_MANAGER_MAX_PMS = 10
+PM_MANAGER_FAST_PATH = True  # Skip the PM manager solver when greedy packing is provably tight
 
 # Hard time limits
 HARD_TIME_LIMIT_MACRO = TIME_STEP / 2
@@ -66,7 +78,32 @@ EPGAP_MICRO = 0.01
 EPGAP_MIGRATION = 0.02
 EPGAP_PM_MANAGER = 0.03
 
+# Anytime solving
+ANYTIME_SOLVING = True  # CPLEX stops at the hard time limit and returns its best incumbent
+ANYTIME_MAX_GAP = 0.05  # Maximum MIP gap for a time-limited incumbent to be accepted
+ANYTIME_BACKSTOP_TIME = 2  # Seconds after the hard time limit before the OPL process is killed
+
+# Solver artifacts (model inputs and OPL outputs of each solve)
+MODEL_ARTIFACTS_RETENTION = "all"  # "all", "failures", "last_steps" or "none"
+MODEL_ARTIFACTS_LAST_STEPS = 10  # Number of steps kept with the "last_steps" retention
+MODEL_ARTIFACTS_IN_MEMORY = False  # Stage artifacts in memory and write only the retained ones
+
 USE_LOAD_BALANCER = True
+
+# Consolidation (macro in hybrid, migration in compound and multilayer) only on a fragmented cluster
+CONSOLIDATION_ON_FRAGMENTATION = True
+CONSOLIDATION_FRAGMENTATION_THRESHOLD = 0.3  # Mean idle capacity share of the PMs that are on
+CONSOLIDATION_LIGHT_LOAD = 0.5  # Load up to which a PM is worth evacuating
+CONSOLIDATION_SAVINGS_HORIZON = 10  # Time steps of idle power saved by freeing a PM
+
+# State events that invalidate each phase of the pipeline, a phase is skipped in steps without any of them
+PHASE_INVALIDATING_EVENTS = {
+    "micro": ("new_vms_arrival", "vms_terminated", "migration_completed", "pms_turned_on"),
+    "macro": ("new_vms_arrival", "vms_terminated", "migration_completed", "pms_turned_on"),
+    "migration": ("vms_terminated", "migration_completed", "pms_turned_on"),
+    "load_balancer": ("new_vms_arrival", "vms_terminated", "migration_completed", "pms_turned_on"),
+    "placement": ("new_vms_arrival", "vms_terminated", "migration_completed", "pms_turned_on"),
+}
 if not USE_REAL_DATA:
     WORKLOAD_NAME = "synthetic"
 
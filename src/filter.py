@@ -1,5 +1,7 @@
 import heapq
 from itertools import islice
+from math import inf
+from placement import FREE_CAPACITY_TOLERANCE, get_free_capacity, vm_fits_on_pm
 from weights import EPSILON, w_load_cpu
 
 
@@ -32,7 +34,7 @@ def is_pm_full(pm):
     )
 
 
-def filter_migrating_pms(active_vms, physical_machines):
+def get_migrating_pm_ids(active_vms):
     # Collect PM IDs with ongoing migrations
     pms_with_ongoing_migrations = set()
     for vm in active_vms.values():
@@ -40,26 +42,27 @@ def filter_migrating_pms(active_vms, physical_machines):
             pms_with_ongoing_migrations.add(vm["migration"]["to_pm"])
         if vm["migration"]["from_pm"] != -1:
             pms_with_ongoing_migrations.add(vm["migration"]["from_pm"])
+    return pms_with_ongoing_migrations
 
-    for pm_id in pms_with_ongoing_migrations:
+
+def filter_migrating_pms(active_vms, physical_machines, migrating_pm_ids=None):
+    if migrating_pm_ids is None:
+        migrating_pm_ids = get_migrating_pm_ids(active_vms)
+
+    for pm_id in migrating_pm_ids:
         if pm_id in physical_machines:
             del physical_machines[pm_id]
 
 
-def filter_full_and_migrating_pms(active_vms, physical_machines):
-    # Collect PM IDs with ongoing migrations
-    pms_with_ongoing_migrations = set()
-    for vm in active_vms.values():
-        if vm["migration"]["to_pm"] != -1:
-            pms_with_ongoing_migrations.add(vm["migration"]["to_pm"])
-        if vm["migration"]["from_pm"] != -1:
-            pms_with_ongoing_migrations.add(vm["migration"]["from_pm"])
+def filter_full_and_migrating_pms(active_vms, physical_machines, migrating_pm_ids=None):
+    if migrating_pm_ids is None:
+        migrating_pm_ids = get_migrating_pm_ids(active_vms)
 
     # Create a list of PM IDs to remove
     pm_ids_to_remove = [
         pm_id
         for pm_id, pm in physical_machines.items()
-        if pm_id in pms_with_ongoing_migrations
+        if pm_id in migrating_pm_ids
         or pm["s"]["load"]["cpu"] >= 1 - EPSILON
         or pm["s"]["load"]["memory"] >= 1 - EPSILON
     ]
@@ -80,6 +83,46 @@ def filter_fragmented_pms(physical_machines, limit=100):
         return physical_machines
 
 
+def build_fragmentation_queue(physical_machines):
+    # Least loaded PMs first, in the order of sort_key_load, PM order on ties
+    queue = [
+        (
+            max(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
+            min(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
+            position,
+            pm_id,
+        )
+        for position, (pm_id, pm) in enumerate(physical_machines.items())
+    ]
+    heapq.heapify(queue)
+    return queue
+
+
+def pop_fragmented_pms(queue, physical_machines, limit=100):
+    # Same selection as filter_fragmented_pms, for PMs whose loads only grow between calls
+    if len(physical_machines) <= limit:
+        return physical_machines
+
+    fragmented_pms = {}
+    while queue and len(fragmented_pms) < limit:
+        max_load, min_load, position, pm_id = heapq.heappop(queue)
+        pm = physical_machines.get(pm_id)
+        if pm is None:
+            continue  # PM was filtered out or already selected
+        load = pm["s"]["load"]
+        current_max_load = max(load["cpu"], load["memory"])
+        current_min_load = min(load["cpu"], load["memory"])
+        if (current_max_load, current_min_load) != (max_load, min_load):
+            # Stale entry, requeue the PM with its current load
+            heapq.heappush(
+                queue, (current_max_load, current_min_load, position, pm_id)
+            )
+            continue
+        fragmented_pms[pm_id] = pm
+
+    return fragmented_pms
+
+
 def filter_pms_to_turn_off_after_migration(
     physical_machines, pms_to_turn_off_after_migration
 ):
@@ -141,6 +184,31 @@ def filter_vms_on_pms_and_non_allocated(vms, physical_machines, scheduled_vms):
     return filtered_vms
 
 
+def get_fixed_pm(vm, pm_ids):
+    # PM the macro model has to keep the VM on, None if the VM is movable
+    if vm["allocation"]["pm"] in pm_ids:
+        return vm["allocation"]["pm"]  # Allocations cannot be moved
+    if vm["migration"]["to_pm"] in pm_ids and vm["migration"]["from_pm"] not in pm_ids:
+        return vm["migration"]["to_pm"]  # Ongoing migrations have to complete
+    return None
+
+
+def split_fixed_vms(vms, physical_machines):
+    # Movable VMs, and the VMs fixed on each PM
+    pm_ids = set(physical_machines.keys())
+    movable_vms = {}
+    fixed_vms_on_pms = {}
+
+    for vm_id, vm in vms.items():
+        fixed_pm = get_fixed_pm(vm, pm_ids)
+        if fixed_pm is None:
+            movable_vms[vm_id] = vm
+        else:
+            fixed_vms_on_pms.setdefault(fixed_pm, []).append(vm)
+
+    return movable_vms, fixed_vms_on_pms
+
+
 def get_fragmented_pms_list(physical_machines, limit=100):
     if len(physical_machines) > limit:
         return heapq.nlargest(limit, physical_machines.values(), key=sort_key_load)
@@ -148,49 +216,117 @@ def get_fragmented_pms_list(physical_machines, limit=100):
         return list(physical_machines.values())
 
 
+def static_key_energy_intensity_capacity(pm, energy_intensity_database):
+    return energy_intensity_database[pm["type"]]["0.0"] / (
+        w_load_cpu * pm["capacity"]["cpu"] + (1 - w_load_cpu) * pm["capacity"]["memory"]
+    )
+
+
 def sort_key_energy_intensity_capacity(pm, energy_intensity_database):
     return (
-        energy_intensity_database[pm["type"]]["0.0"]
-        / (
-            w_load_cpu * pm["capacity"]["cpu"]
-            + (1 - w_load_cpu) * pm["capacity"]["memory"]
-        ),
+        static_key_energy_intensity_capacity(pm, energy_intensity_database),
         pm["s"]["time_to_turn_on"],
     )
 
 
 def sort_key_load(pm):
-    return (
-        -max(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
-        -min(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
-    )
+    cpu_load = pm["s"]["load"]["cpu"]
+    memory_load = pm["s"]["load"]["memory"]
+    if cpu_load >= memory_load:
+        return (-cpu_load, -memory_load)
+    return (-memory_load, -cpu_load)
+
+
+def static_key_energy_intensity(pm, energy_intensity_database):
+    return energy_intensity_database[pm["type"]]["0.0"]
 
 
 def sort_key_energy_intensity_load(pm, energy_intensity_database):
-    return (
-        energy_intensity_database[pm["type"]]["0.0"],
-        -max(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
-        -min(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"]),
+    return (static_key_energy_intensity(pm, energy_intensity_database),) + sort_key_load(
+        pm
     )
 
 
-def split_dict_sorted(d, max_elements_per_subset, sort_key, energy_intensity_database):
-    items_with_keys = sorted(
-        (
-            (sort_key(value, energy_intensity_database), key, value)
-            for key, value in d.items()
+# Sort keys made of a static part, fixed by PM type and capacity, and a dynamic tie-break
+sort_key_parts = {
+    sort_key_energy_intensity_capacity: (
+        static_key_energy_intensity_capacity,
+        lambda pm: (pm["s"]["time_to_turn_on"],),
+    ),
+    sort_key_energy_intensity_load: (static_key_energy_intensity, sort_key_load),
+}
+
+# Static sort keys computed so far, static key function -> {PM ID: key}
+static_sort_keys = {}
+
+# Last order returned for each sort key, as PM IDs
+last_sort_orders = {}
+
+
+def sort_items_by_key(d, sort_key, energy_intensity_database):
+    # Items of d as (key, value) pairs in sort_key order, ties broken by key
+    if sort_key not in sort_key_parts:
+        return [
+            (key, value)
+            for _, key, value in sorted(
+                (sort_key(value, energy_intensity_database), key, value)
+                for key, value in d.items()
+            )
+        ]
+
+    static_key, dynamic_key = sort_key_parts[sort_key]
+    static_values = static_sort_keys.setdefault(static_key, {})
+
+    keys = {}
+    for key, value in d.items():
+        static_value = static_values.get(key)
+        if static_value is None:
+            static_value = static_values[key] = static_key(
+                value, energy_intensity_database
+            )
+        keys[key] = (static_value, dynamic_key(value), key)
+
+    # Sort from the last order, which stays nearly sorted since only the tie-break moves
+    items_with_keys = [
+        keys.pop(key) for key in last_sort_orders.get(sort_key, ()) if key in keys
+    ]
+    items_with_keys.extend(keys.values())
+    items_with_keys.sort()
+
+    order = [key for _, _, key in items_with_keys]
+    last_sort_orders[sort_key] = order
+    return [(key, d[key]) for key in order]
+
+
+def get_migration_candidate_pms(vms, physical_machines, limit, energy_intensity_database):
+    # PMs with room for at least one of the VMs, most efficient then most loaded first
+    candidate_pms = [
+        pm
+        for pm in physical_machines.values()
+        if any(vm_fits_on_pm(vm, pm) for vm in vms.values())
+    ]
+    if limit and len(candidate_pms) > limit:
+        candidate_pms = heapq.nsmallest(
+            limit,
+            candidate_pms,
+            key=lambda pm: (
+                static_key_energy_intensity(pm, energy_intensity_database),
+                sort_key_load(pm),
+            ),
         )
-    )
+    return {pm["id"]: pm for pm in candidate_pms}
+
+
+def split_dict_sorted(d, max_elements_per_subset, sort_key, energy_intensity_database):
+    items = sort_items_by_key(d, sort_key, energy_intensity_database)
 
     # Calculate the number of subsets
-    n = len(items_with_keys)
+    n = len(items)
     subsets = []
 
     # Split the sorted items into subsets
     for i in range(0, n, max_elements_per_subset):
-        subset_items = items_with_keys[i : i + max_elements_per_subset]
-        subset = {key: value for _, key, value in subset_items}
-        subsets.append(subset)
+        subsets.append(dict(items[i : i + max_elements_per_subset]))
 
     return subsets
 
@@ -199,3 +335,106 @@ def split_dict_unsorted(d, max_size):
     it = iter(d.items())
     for _ in range(0, len(d), max_size):
         yield dict(islice(it, max_size))
+
+
+def sort_backlog_by_revenue(vms):
+    # Highest revenue per second first
+    return dict(
+        sorted(
+            vms.items(),
+            key=lambda item: item[1]["revenue"] / item[1]["run"]["total_time"],
+            reverse=True,
+        )
+    )
+
+
+def split_backlog_by_revenue(vms, max_admitted_vms):
+    # The VMs beyond the limit are returned apart
+    sorted_vms = list(sort_backlog_by_revenue(vms).items())
+    return dict(sorted_vms[:max_admitted_vms]), dict(sorted_vms[max_admitted_vms:])
+
+
+def co_partition_vms_and_pms(vms, pm_subsets, max_vms_per_subset=None):
+    # Free cpu and memory of each PM subset, in total and on its largest PM
+    free_capacity = []
+    for pm_subset in pm_subsets:
+        pm_free_capacity = [get_free_capacity(pm) for pm in pm_subset.values()]
+        pm_free_capacity = [free for free in pm_free_capacity if free[0] > -inf]
+        free_capacity.append(
+            [
+                sum(free[0] for free in pm_free_capacity),
+                sum(free[1] for free in pm_free_capacity),
+                max((free[0] for free in pm_free_capacity), default=-inf),
+                max((free[1] for free in pm_free_capacity), default=-inf),
+            ]
+        )
+
+    # Largest VMs first, relative to the largest PM
+    max_cpu = max(
+        (pm["capacity"]["cpu"] for pm_subset in pm_subsets for pm in pm_subset.values()),
+        default=1,
+    )
+    max_memory = max(
+        (
+            pm["capacity"]["memory"]
+            for pm_subset in pm_subsets
+            for pm in pm_subset.values()
+        ),
+        default=1,
+    )
+    sorted_vms = sorted(
+        vms.items(),
+        key=lambda item: max(
+            item[1]["requested"]["cpu"] / max_cpu,
+            item[1]["requested"]["memory"] / max_memory,
+        ),
+        reverse=True,
+    )
+
+    # Share of the free capacity of each PM subset taken by its VMs
+    total_free_capacity = [
+        (max(free[0], FREE_CAPACITY_TOLERANCE), max(free[1], FREE_CAPACITY_TOLERANCE))
+        for free in free_capacity
+    ]
+
+    def get_fill_ratio(position, cpu, memory):
+        free = free_capacity[position]
+        total = total_free_capacity[position]
+        return max(
+            (total[0] - free[0] + cpu) / total[0],
+            (total[1] - free[1] + memory) / total[1],
+        )
+
+    # Each VM goes to the least filled PM subset with room for it in total and on a single PM,
+    # so the subsets get VMs in proportion to their free capacity
+    vm_subsets = [{} for _ in pm_subsets]
+    for vm_id, vm in sorted_vms:
+        cpu = vm["requested"]["cpu"]
+        memory = vm["requested"]["memory"]
+        fitting_positions = [
+            position
+            for position, free in enumerate(free_capacity)
+            if not (
+                max_vms_per_subset and len(vm_subsets[position]) >= max_vms_per_subset
+            )
+            and cpu <= free[0] + FREE_CAPACITY_TOLERANCE
+            and memory <= free[1] + FREE_CAPACITY_TOLERANCE
+            and cpu <= free[2] + FREE_CAPACITY_TOLERANCE
+            and memory <= free[3] + FREE_CAPACITY_TOLERANCE
+        ]
+        if not fitting_positions:
+            continue
+        position = min(
+            fitting_positions,
+            key=lambda position: (get_fill_ratio(position, cpu, memory), position),
+        )
+        vm_subsets[position][vm_id] = vm
+        free_capacity[position][0] -= cpu
+        free_capacity[position][1] -= memory
+
+    # VMs that fit in no PM subset are left out
+    return [
+        (vm_subset, pm_subset)
+        for vm_subset, pm_subset in zip(vm_subsets, pm_subsets)
+        if vm_subset
+    ]
@@ -88,6 +88,9 @@ MICRO_MODEL_MAX_VMS = getattr(config, "MICRO_MODEL_MAX_VMS", None)
 MIGRATION_MODEL_MAX_FRAGMENTED_PMS = getattr(
     config, "MIGRATION_MODEL_MAX_FRAGMENTED_PMS", None
 )
+MIGRATION_MODEL_MAX_CANDIDATE_PMS = getattr(
+    config, "MIGRATION_MODEL_MAX_CANDIDATE_PMS", None
+)
 FAILED_MIGRATIONS_LIMIT = getattr(config, "FAILED_MIGRATIONS_LIMIT", None)
 PM_MANAGER_MAX_PMS = getattr(config, "PM_MANAGER_MAX_PMS", None)
 EPGAP_MACRO = getattr(config, "EPGAP_MACRO", None)
@@ -97,6 +100,7 @@ EPGAP_PM_MANAGER = getattr(config, "EPGAP_PM_MANAGER", None)
 HARD_TIME_LIMIT_MACRO = getattr(config, "HARD_TIME_LIMIT_MACRO", None)
 HARD_TIME_LIMIT_MICRO = getattr(config, "HARD_TIME_LIMIT_MICRO", None)
 HARD_TIME_LIMIT_MIGRATION = getattr(config, "HARD_TIME_LIMIT_MIGRATION", None)
+ANYTIME_SOLVING = getattr(config, "ANYTIME_SOLVING", None)
 
 # Set VMS_TRACE_FILE if --trace argument is provided
 if USE_REAL_DATA:
@@ -142,10 +146,27 @@ if __name__ == "__main__":
     initial_pms = load_physical_machines(os.path.expanduser(INITIAL_PMS_FILE))
     log_folder_path, performance_log_file, vm_execution_time_file = create_log_folder()
     log_initial_physical_machines(initial_pms, log_folder_path)
-    load_configuration(MACRO_MODEL_INPUT_FOLDER_PATH, EPGAP_MACRO)
-    load_configuration(MICRO_MODEL_INPUT_FOLDER_PATH, EPGAP_MICRO)
-    load_configuration(MIGRATION_MODEL_INPUT_FOLDER_PATH, EPGAP_MIGRATION)
-    load_configuration(PM_MANAGER_INPUT_FOLDER_PATH, EPGAP_PM_MANAGER)
+    load_configuration(
+        MACRO_MODEL_INPUT_FOLDER_PATH,
+        EPGAP_MACRO,
+        HARD_TIME_LIMIT_MACRO if ANYTIME_SOLVING else 0,
+    )
+    load_configuration(
+        MICRO_MODEL_INPUT_FOLDER_PATH,
+        EPGAP_MICRO,
+        HARD_TIME_LIMIT_MICRO if ANYTIME_SOLVING else 0,
+    )
+    load_configuration(
+        MIGRATION_MODEL_INPUT_FOLDER_PATH,
+        EPGAP_MIGRATION,
+        HARD_TIME_LIMIT_MIGRATION if ANYTIME_SOLVING else 0,
+    )
+    # The PM manager solves micro.mod, with the same time limit as the micro model
+    load_configuration(
+        PM_MANAGER_INPUT_FOLDER_PATH,
+        EPGAP_PM_MANAGER,
+        HARD_TIME_LIMIT_MICRO if ANYTIME_SOLVING else 0,
+    )
 
     save_energy_intensity(os.path.expanduser(INITIAL_PMS_FILE))
     (
@@ -194,6 +215,7 @@ if __name__ == "__main__":
         MICRO_MODEL_MAX_PMS,
         MICRO_MODEL_MAX_VMS,
         MIGRATION_MODEL_MAX_FRAGMENTED_PMS,
+        MIGRATION_MODEL_MAX_CANDIDATE_PMS,
         FAILED_MIGRATIONS_LIMIT,
         PM_MANAGER_MAX_PMS,
         HARD_TIME_LIMIT_MACRO,
@@ -1,12 +1,17 @@
+import math
 import os
 import re
 
+import numpy as np
+from scipy.optimize import Bounds, LinearConstraint, milp
+from scipy.sparse import coo_array
+
+from artifacts import write_model_artifact
 from utils import (
     convert_pms_to_model_input_format,
     convert_energy_intensity_to_model_input_format,
-    convert_vms_to_model_input_format,
-    parse_matrix,
 )
+from weights import price, pue, w_load_cpu
 
 try:
     profile  # type: ignore
@@ -16,12 +21,202 @@ except NameError:
         return func
 
 
+def get_pm_class_key(pm):
+    return (
+        pm["type"],
+        pm["capacity"]["cpu"],
+        pm["capacity"]["memory"],
+        pm["s"]["state"],
+        pm["s"]["time_to_turn_on"],
+        pm["s"]["time_to_turn_off"],
+        pm["s"]["load"]["cpu"],
+        pm["s"]["load"]["memory"],
+    )
+
+
+def group_interchangeable_pms(pms):
+    # PMs with the same type, capacity and state are interchangeable for the solver
+    pm_classes = {}
+    for pm_id, pm in pms.items():
+        pm_classes.setdefault(get_pm_class_key(pm), []).append(pm_id)
+    return list(pm_classes.values())
+
+
+def reduce_interchangeable_pms(vms, pms):
+    pm_ids_to_keep = set()
+
+    for pm_class in group_interchangeable_pms(pms):
+        pm = pms[pm_class[0]]
+        # No solution uses more PMs of a class than there are VMs fitting on one of them
+        num_fitting_vms = sum(
+            1
+            for vm in vms.values()
+            if pm["s"]["load"]["cpu"] + vm["requested"]["cpu"] / pm["capacity"]["cpu"]
+            <= 1
+            and pm["s"]["load"]["memory"]
+            + vm["requested"]["memory"] / pm["capacity"]["memory"]
+            <= 1
+        )
+        pm_ids_to_keep.update(pm_class[:num_fitting_vms])
+
+    return {pm_id: pm for pm_id, pm in pms.items() if pm_id in pm_ids_to_keep}
+
+
+def convert_symmetric_pms_to_model_input_format(pms):
+    legend = "// <first, second> pairs of interchangeable PMs, used in order by the solver\n"
+    formatted_pairs = "\n\n" + legend + "\nsymmetric_pms = {\n"
+    for pm_class in group_interchangeable_pms(pms):
+        for first, second in zip(pm_class, pm_class[1:]):
+            formatted_pairs += f"  <{first}, {second}>,\n"
+    formatted_pairs = formatted_pairs.rstrip(",\n") + "\n};\n"
+    return formatted_pairs
+
+
+def group_vms_by_size(vms):
+    # VMs with the same requested resources are interchangeable for the solver
+    vm_classes = {}
+    for vm_id, vm in vms.items():
+        size = (vm["requested"]["cpu"], vm["requested"]["memory"])
+        vm_classes.setdefault(size, []).append(vm_id)
+    return {
+        class_id: {"requested": {"cpu": size[0], "memory": size[1]}, "vm_ids": vm_ids}
+        for class_id, (size, vm_ids) in enumerate(vm_classes.items())
+    }
+
+
+def convert_vm_classes_to_model_input_format(vm_classes):
+    legend = "// <id, requested (cpu, memory), count>\n"
+    formatted_vm_classes = legend + "\nvirtual_machines = {\n"
+    for class_id, vm_class in vm_classes.items():
+        formatted_vm_classes += f"  <{class_id}, <{vm_class['requested']['cpu']}, {vm_class['requested']['memory']}>, {len(vm_class['vm_ids'])}>,\n"
+    formatted_vm_classes = formatted_vm_classes.rstrip(",\n") + "\n};"
+    return formatted_vm_classes
+
+
+def get_max_vms_on_pm(requested, pm):
+    # Number of VMs of the given size fitting in the free capacity of the PM
+    max_vms = math.inf
+    for resource in ("cpu", "memory"):
+        if requested[resource] > 0:
+            free = (1 - pm["s"]["load"][resource]) * pm["capacity"][resource]
+            max_vms = min(max_vms, math.floor(free / requested[resource] + 1e-9))
+    return max_vms
+
+
+def get_allowed_assignments(vm_classes, pms):
+    # (class, PM, max count) for every PM with room for at least one VM of the class
+    assignments = []
+    for pm_id, pm in pms.items():
+        if pm["s"]["state"] == 0 and pm["s"]["time_to_turn_off"] > 0:
+            continue  # PM is turning off
+        for class_id, vm_class in vm_classes.items():
+            count = min(
+                len(vm_class["vm_ids"]), get_max_vms_on_pm(vm_class["requested"], pm)
+            )
+            if count > 0:
+                assignments.append((class_id, pm_id, count))
+    return assignments
+
+
+def convert_assignments_to_model_input_format(assignments):
+    legend = "// <vm, pm, count> pairs a VM class may be allocated to, at most count VMs\n"
+    formatted_assignments = "\n\n" + legend + "\nassignments = {\n"
+    for class_id, pm_id, count in assignments:
+        formatted_assignments += f"  <{class_id}, {pm_id}, {count}>,\n"
+    formatted_assignments = formatted_assignments.rstrip(",\n") + "\n};\n"
+    return formatted_assignments
+
+
+def get_allocation_start(vm_classes, pms, assignments, preferred_pm_ids=None):
+    # Greedy start for the solver, VMs on their preferred PM first, then first-fit decreasing
+    allowed = {(class_id, pm_id) for class_id, pm_id, _ in assignments}
+    free = {
+        pm_id: {
+            resource: (1 - pm["s"]["load"][resource]) * pm["capacity"][resource]
+            for resource in ("cpu", "memory")
+        }
+        for pm_id, pm in pms.items()
+    }
+    counts = {}
+
+    def place(class_id, pm_id):
+        requested = vm_classes[class_id]["requested"]
+        if (class_id, pm_id) not in allowed or any(
+            requested[resource] > free[pm_id][resource] + 1e-9
+            for resource in ("cpu", "memory")
+        ):
+            return False
+        for resource in ("cpu", "memory"):
+            free[pm_id][resource] -= requested[resource]
+        counts[(class_id, pm_id)] = counts.get((class_id, pm_id), 0) + 1
+        return True
+
+    pending_class_ids = []
+    for class_id, vm_class in vm_classes.items():
+        for vm_id in vm_class["vm_ids"]:
+            pm_id = (preferred_pm_ids or {}).get(vm_id)
+            if pm_id is None or not place(class_id, pm_id):
+                pending_class_ids.append(class_id)
+
+    pending_class_ids.sort(
+        key=lambda class_id: (
+            vm_classes[class_id]["requested"]["cpu"],
+            vm_classes[class_id]["requested"]["memory"],
+        ),
+        reverse=True,
+    )
+    for class_id in pending_class_ids:
+        for pm_id in pms.keys():
+            if place(class_id, pm_id):
+                break
+
+    # Interchangeable PMs are loaded in order, as the symmetry breaking constraints require
+    for pm_class in group_interchangeable_pms(pms):
+        pm = pms[pm_class[0]]
+        contents = [
+            {
+                class_id: counts.pop((class_id, pm_id))
+                for class_id in vm_classes.keys()
+                if (class_id, pm_id) in counts
+            }
+            for pm_id in pm_class
+        ]
+        contents.sort(
+            key=lambda content: sum(
+                count
+                * (
+                    w_load_cpu
+                    * vm_classes[class_id]["requested"]["cpu"]
+                    / pm["capacity"]["cpu"]
+                    + (1 - w_load_cpu)
+                    * vm_classes[class_id]["requested"]["memory"]
+                    / pm["capacity"]["memory"]
+                )
+                for class_id, count in content.items()
+            ),
+            reverse=True,
+        )
+        for pm_id, content in zip(pm_class, contents):
+            for class_id, count in content.items():
+                counts[(class_id, pm_id)] = count
+
+    return [counts.get((class_id, pm_id), 0) for class_id, pm_id, _ in assignments]
+
+
+def convert_allocation_start_to_model_input_format(allocation_start):
+    formatted_values = ", ".join(str(count) for count in allocation_start)
+    return f"\n// Initial solution, VMs of each allowed assignment\n\nallocation_init = [{formatted_values}];\n"
+
+
 def save_micro_model_input_format(
-    vms, pms, step, model_input_folder_path, energy_intensity_database, nb_points
+    vms,
+    pms,
+    step,
+    model_input_folder_path,
+    energy_intensity_database,
+    nb_points,
+    preferred_pm_ids=None,
 ):
-    # Ensure the directory exists
-    os.makedirs(model_input_folder_path, exist_ok=True)
-
     # Construct file paths
     base_filename = f"_t{step}.dat"
     vm_model_input_file_path = os.path.join(
@@ -31,30 +226,76 @@ def save_micro_model_input_format(
         model_input_folder_path, "physical_machines" + base_filename
     )
 
-    # Convert data to the required format
-    formatted_vms = convert_vms_to_model_input_format(vms)
+    # Convert data to the required format, VMs aggregated into size classes
+    vm_classes = group_vms_by_size(vms)
+    formatted_vms = convert_vm_classes_to_model_input_format(vm_classes)
     formatted_pms = convert_pms_to_model_input_format(pms)
     formatted_energy_intensity = convert_energy_intensity_to_model_input_format(
         pms, energy_intensity_database, nb_points
     )
+    formatted_symmetric_pms = convert_symmetric_pms_to_model_input_format(pms)
+    assignments = get_allowed_assignments(vm_classes, pms)
+    formatted_assignments = convert_assignments_to_model_input_format(assignments)
+    formatted_allocation_start = convert_allocation_start_to_model_input_format(
+        get_allocation_start(vm_classes, pms, assignments, preferred_pm_ids)
+    )
 
     # Write formatted VMs to file
-    with open(vm_model_input_file_path, "w") as vm_file:
-        vm_file.write(formatted_vms)
+    write_model_artifact(vm_model_input_file_path, formatted_vms)
+
+    # Write formatted PMs, energy_intensity function, symmetric PMs, allowed assignments and start to file
+    write_model_artifact(
+        pm_model_input_file_path,
+        formatted_pms
+        + formatted_energy_intensity
+        + formatted_symmetric_pms
+        + formatted_assignments
+        + formatted_allocation_start,
+    )
+
+    return vm_model_input_file_path, pm_model_input_file_path, vm_classes
+
+
+def parse_allocation_pairs(pairs_str, class_ids, pm_ids):
+    # Dense class x PM matrix from the <vm pm count> entries of the sparse allocation
+    class_indices = {class_id: index for index, class_id in enumerate(class_ids)}
+    pm_indices = {pm_id: index for index, pm_id in enumerate(pm_ids)}
+    class_allocation = [[0] * len(pm_ids) for _ in class_ids]
+    for class_id, pm_id, count in re.findall(r"<(\d+) (\d+) ([\d.e+-]+)>", pairs_str):
+        class_allocation[class_indices[int(class_id)]][pm_indices[int(pm_id)]] = round(
+            float(count)
+        )
+    return class_allocation
 
-    # Write formatted PMs and energy_intensity function to file
-    with open(pm_model_input_file_path, "w") as pm_file:
-        pm_file.write(formatted_pms)
-        pm_file.write(formatted_energy_intensity)
 
-    return vm_model_input_file_path, pm_model_input_file_path
+def disaggregate_allocation(parsed_data, vm_classes):
+    # Hand out the VMs of each class to PMs according to the per-class counts
+    class_allocation = parsed_data["allocation"]
+    class_ids = parsed_data["vm_ids"]
+    num_pms = len(parsed_data["pm_ids"])
 
+    vm_ids = []
+    allocation = []
+    for class_index, class_id in enumerate(class_ids):
+        class_vm_ids = vm_classes[class_id]["vm_ids"]
+        vm_ids.extend(class_vm_ids)
+        rows = [[0] * num_pms for _ in class_vm_ids]
+        vm_index = 0
+        for pm_index in range(num_pms):
+            for _ in range(round(class_allocation[class_index][pm_index])):
+                rows[vm_index][pm_index] = 1
+                vm_index += 1
+        allocation.extend(rows)
 
-def parse_micro_opl_output(output):
+    parsed_data["vm_ids"] = vm_ids
+    parsed_data["allocation"] = allocation
+
+
+def parse_micro_opl_output(output, vm_classes):
     parsed_data = {}
 
     patterns = {
-        "allocation": re.compile(r"allocation = \[\[(.*?)\]\];", re.DOTALL),
+        "allocation": re.compile(r"allocation_pairs = \[(.*?)\]"),
         "vm_ids": re.compile(r"Virtual Machines IDs: \[(.*?)\]"),
         "pm_ids": re.compile(r"Physical Machines IDs: \[(.*?)\]"),
         "cpu_load": re.compile(r"cpu_load = \[(.*?)\]"),
@@ -65,16 +306,240 @@ def parse_micro_opl_output(output):
         match = pattern.search(output)
         if match:
             if key in ["allocation"]:
-                parsed_data[key] = parse_matrix(match.group(1))
+                parsed_data[key] = match.group(1)
             else:
                 parsed_data[key] = [
                     int(num) if num.isdigit() else float(num)
                     for num in match.group(1).strip().split()
                 ]
 
+    if "allocation" in parsed_data and "vm_ids" in parsed_data and "pm_ids" in parsed_data:
+        parsed_data["allocation"] = parse_allocation_pairs(
+            parsed_data["allocation"], parsed_data["vm_ids"], parsed_data["pm_ids"]
+        )
+        disaggregate_allocation(parsed_data, vm_classes)
+    else:
+        parsed_data.pop("allocation", None)
+
     return parsed_data
 
 
+def get_energy_intensity_segments(energy_intensity_function):
+    # (length, slope) of each linear piece of the function, as the pwlFunction of micro.mod
+    points = [(float(x), y) for x, y in energy_intensity_function.items()]
+    return [
+        (x - previous_x, (y - previous_y) / (x - previous_x))
+        for (previous_x, previous_y), (x, y) in zip(points, points[1:])
+    ]
+
+
+def solve_micro_model_with_highs(
+    vms, pms, energy_intensity_database, time_limit=None, epgap=None
+):
+    # micro.mod built in memory and solved with scipy.optimize.milp
+    # Returns the parsed solution (None without one), the milp status and the MIP gap
+    vm_classes = group_vms_by_size(vms)
+    assignments = get_allowed_assignments(vm_classes, pms)
+    class_ids = list(vm_classes.keys())
+    pm_ids = list(pms.keys())
+    pm_indices = {pm_id: index for index, pm_id in enumerate(pm_ids)}
+
+    # Variables: allocation of each assignment, is_on of each PM, then the filled length of each energy segment
+    num_assignments = len(assignments)
+    num_pms = len(pm_ids)
+    segments = {
+        pm_type: get_energy_intensity_segments(energy_intensity_database[pm_type])
+        for pm_type in {pm["type"] for pm in pms.values()}
+    }
+    segment_columns = {}
+    column = num_assignments + num_pms
+    for pm_id in pm_ids:
+        segment_columns[pm_id] = column
+        column += len(segments[pms[pm_id]["type"]])
+
+    # Non-convex energy functions need a binary per segment to be filled in order
+    order_columns = {}
+    for pm_id in pm_ids:
+        slopes = [slope for _, slope in segments[pms[pm_id]["type"]]]
+        if any(
+            slope < previous_slope for previous_slope, slope in zip(slopes, slopes[1:])
+        ):
+            order_columns[pm_id] = column
+            column += len(slopes) - 1
+    num_columns = column
+
+    objective = np.zeros(num_columns)
+    lower_bounds = np.zeros(num_columns)
+    upper_bounds = np.ones(num_columns)
+    integrality = np.ones(num_columns)
+
+    # Load contribution of each assignment, cpu, memory and the weighted load of the energy function
+    load_coefficients = []
+    for position, (class_id, pm_id, count) in enumerate(assignments):
+        requested = vm_classes[class_id]["requested"]
+        cpu = requested["cpu"] / pms[pm_id]["capacity"]["cpu"]
+        memory = requested["memory"] / pms[pm_id]["capacity"]["memory"]
+        load_coefficients.append(
+            (cpu, memory, w_load_cpu * cpu + (1 - w_load_cpu) * memory)
+        )
+        objective[position] = -(
+            requested["cpu"] * price["cpu"] + requested["memory"] * price["memory"]
+        )
+        upper_bounds[position] = count
+
+    for pm_id in pm_ids:
+        pm_type = pms[pm_id]["type"]
+        objective[num_assignments + pm_indices[pm_id]] = (
+            pue * price["energy"] * energy_intensity_database[pm_type]["0.0"]
+        )
+        for index, (length, slope) in enumerate(segments[pm_type]):
+            objective[segment_columns[pm_id] + index] = pue * price["energy"] * slope
+            upper_bounds[segment_columns[pm_id] + index] = length
+            integrality[segment_columns[pm_id] + index] = 0
+
+    rows, columns, values, row_lower_bounds, row_upper_bounds = [], [], [], [], []
+
+    def add_row(entries, lower_bound, upper_bound):
+        for entry_column, value in entries:
+            rows.append(len(row_lower_bounds))
+            columns.append(entry_column)
+            values.append(value)
+        row_lower_bounds.append(lower_bound)
+        row_upper_bounds.append(upper_bound)
+
+    assignments_of_vm = {class_id: [] for class_id in class_ids}
+    assignments_on_pm = {pm_id: [] for pm_id in pm_ids}
+    for position, (class_id, pm_id, _) in enumerate(assignments):
+        assignments_of_vm[class_id].append(position)
+        assignments_on_pm[pm_id].append(position)
+
+    # A Virtual Machine is assigned maximum to one Physical Machine
+    for class_id in class_ids:
+        add_row(
+            [(position, 1) for position in assignments_of_vm[class_id]],
+            -np.inf,
+            len(vm_classes[class_id]["vm_ids"]),
+        )
+
+    for pm_id in pm_ids:
+        load = pms[pm_id]["s"]["load"]
+        is_on_column = num_assignments + pm_indices[pm_id]
+        for resource_index, resource in enumerate(("cpu", "memory")):
+            entries = [
+                (position, load_coefficients[position][resource_index])
+                for position in assignments_on_pm[pm_id]
+            ]
+            # Physical Machine CPU and Memory capacity
+            add_row(entries, -np.inf, 1 - load[resource])
+            # If a Physical Machine is loaded, it has to be ON
+            add_row(
+                [(is_on_column, 1)]
+                + [(entry_column, -value) for entry_column, value in entries],
+                load[resource],
+                np.inf,
+            )
+
+        # The energy segments add up to the weighted load
+        pm_segments = segments[pms[pm_id]["type"]]
+        add_row(
+            [(segment_columns[pm_id] + index, 1) for index in range(len(pm_segments))]
+            + [
+                (position, -load_coefficients[position][2])
+                for position in assignments_on_pm[pm_id]
+            ],
+            w_load_cpu * load["cpu"] + (1 - w_load_cpu) * load["memory"],
+            w_load_cpu * load["cpu"] + (1 - w_load_cpu) * load["memory"],
+        )
+
+        # A segment is only filled once the previous one is full
+        if pm_id in order_columns:
+            for index in range(len(pm_segments) - 1):
+                order_column = order_columns[pm_id] + index
+                add_row(
+                    [
+                        (segment_columns[pm_id] + index, 1),
+                        (order_column, -pm_segments[index][0]),
+                    ],
+                    0,
+                    np.inf,
+                )
+                add_row(
+                    [
+                        (segment_columns[pm_id] + index + 1, 1),
+                        (order_column, -pm_segments[index + 1][0]),
+                    ],
+                    -np.inf,
+                    0,
+                )
+
+    # Symmetry breaking: interchangeable Physical Machines are turned on and loaded in order
+    for pm_class in group_interchangeable_pms(pms):
+        for first, second in zip(pm_class, pm_class[1:]):
+            add_row(
+                [
+                    (num_assignments + pm_indices[first], 1),
+                    (num_assignments + pm_indices[second], -1),
+                ],
+                0,
+                np.inf,
+            )
+            add_row(
+                [
+                    (position, load_coefficients[position][2])
+                    for position in assignments_on_pm[first]
+                ]
+                + [
+                    (position, -load_coefficients[position][2])
+                    for position in assignments_on_pm[second]
+                ],
+                0,
+                np.inf,
+            )
+
+    # Prices are tiny, scale the objective so that the solver tolerances do not swallow it
+    scale = np.abs(objective).max()
+    if scale > 0:
+        objective /= scale
+
+    options = {}
+    if time_limit:
+        options["time_limit"] = time_limit
+    if epgap is not None:
+        options["mip_rel_gap"] = epgap
+
+    constraints = LinearConstraint(
+        coo_array(
+            (values, (rows, columns)), shape=(len(row_lower_bounds), num_columns)
+        ).tocsr(),
+        row_lower_bounds,
+        row_upper_bounds,
+    )
+    result = milp(
+        objective,
+        integrality=integrality,
+        bounds=Bounds(lower_bounds, upper_bounds),
+        constraints=constraints,
+        options=options,
+    )
+    if result.x is None:
+        return None, result.status, result.mip_gap
+
+    # Same data as parse_micro_opl_output, ready for micro_reallocate_vms
+    class_indices = {class_id: index for index, class_id in enumerate(class_ids)}
+    class_allocation = [[0] * num_pms for _ in class_ids]
+    for position, (class_id, pm_id, _) in enumerate(assignments):
+        class_allocation[class_indices[class_id]][pm_indices[pm_id]] = round(
+            result.x[position]
+        )
+    parsed_data = {
+        "allocation": class_allocation,
+        "vm_ids": class_ids,
+        "pm_ids": pm_ids,
+    }
+    disaggregate_allocation(parsed_data, vm_classes)
+    return parsed_data, result.status, result.mip_gap
+
+
 def micro_reallocate_vms(vm_ids, pm_ids, allocation, non_allocated_vms):
     for vm_index, vm_id in enumerate(vm_ids):
         vm = non_allocated_vms.get(vm_id)
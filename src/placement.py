@@ -0,0 +1,320 @@
+import heapq
+from math import inf
+
+# Slack on the free capacity kept in the tree, the exact fit is checked on the PM itself
+FREE_CAPACITY_TOLERANCE = 1e-9
+
+try:
+    profile  # type: ignore
+except NameError:
+
+    def profile(func):
+        return func
+
+
+def get_free_capacity(pm):
+    # A PM that is turning off accepts no VMs
+    if pm["s"]["state"] == 0 and pm["s"]["time_to_turn_off"] > 0:
+        return -inf, -inf
+    return (
+        pm["capacity"]["cpu"] - pm["s"]["load"]["cpu"] * pm["capacity"]["cpu"],
+        pm["capacity"]["memory"] - pm["s"]["load"]["memory"] * pm["capacity"]["memory"],
+    )
+
+
+def vm_fits_on_pm(vm, pm):
+    if (
+        pm["capacity"]["cpu"]
+        - (pm["s"]["load"]["cpu"] * pm["capacity"]["cpu"] + vm["requested"]["cpu"])
+        >= 0
+        and pm["capacity"]["memory"]
+        - (
+            pm["s"]["load"]["memory"] * pm["capacity"]["memory"]
+            + vm["requested"]["memory"]
+        )
+        >= 0
+        and not (pm["s"]["state"] == 0 and pm["s"]["time_to_turn_off"] > 0)
+    ):
+        if (
+            vm["allocation"]["pm"] == -1
+            and vm["migration"]["to_pm"] == -1
+            and vm["run"]["pm"] != pm["id"]
+        ):
+            return True
+    return False
+
+
+def get_load_rank(pm, position):
+    # Best-fit order, lowest rank first: most loaded PM, earlier position on ties
+    if pm["s"]["state"] == 0 and pm["s"]["time_to_turn_off"] > 0:
+        return (inf, inf, inf)
+    return (-pm["s"]["load"]["cpu"], -pm["s"]["load"]["memory"], position)
+
+
+def build_placement_index(sorted_pms, track_load=False):
+    # Segment tree over the PM order with the max free cpu and memory of each node
+    size = 1
+    while size < len(sorted_pms):
+        size *= 2
+
+    free_cpu = [-inf] * (2 * size)
+    free_memory = [-inf] * (2 * size)
+    for position, pm in enumerate(sorted_pms):
+        free_cpu[size + position], free_memory[size + position] = get_free_capacity(pm)
+    for node in range(size - 1, 0, -1):
+        free_cpu[node] = max(free_cpu[2 * node], free_cpu[2 * node + 1])
+        free_memory[node] = max(free_memory[2 * node], free_memory[2 * node + 1])
+
+    index = {
+        "pms": sorted_pms,
+        "positions": {pm["id"]: position for position, pm in enumerate(sorted_pms)},
+        "size": size,
+        "free_cpu": free_cpu,
+        "free_memory": free_memory,
+    }
+
+    # Min load rank of each node, for best-fit queries
+    if track_load:
+        load_rank = [(inf, inf, inf)] * (2 * size)
+        for position, pm in enumerate(sorted_pms):
+            load_rank[size + position] = get_load_rank(pm, position)
+        for node in range(size - 1, 0, -1):
+            load_rank[node] = min(load_rank[2 * node], load_rank[2 * node + 1])
+        index["load_rank"] = load_rank
+
+    return index
+
+
+def update_placement_index(index, position):
+    free_cpu = index["free_cpu"]
+    free_memory = index["free_memory"]
+
+    load_rank = index.get("load_rank")
+
+    node = index["size"] + position
+    free_cpu[node], free_memory[node] = get_free_capacity(index["pms"][position])
+    if load_rank is not None:
+        load_rank[node] = get_load_rank(index["pms"][position], position)
+    node //= 2
+    while node:
+        free_cpu[node] = max(free_cpu[2 * node], free_cpu[2 * node + 1])
+        free_memory[node] = max(free_memory[2 * node], free_memory[2 * node + 1])
+        if load_rank is not None:
+            load_rank[node] = min(load_rank[2 * node], load_rank[2 * node + 1])
+        node //= 2
+
+
+def find_first_fit(index, vm, end=None):
+    # Position of the first PM before end with room for the VM, None if there is none
+    pms = index["pms"]
+    free_cpu = index["free_cpu"]
+    free_memory = index["free_memory"]
+    if end is None:
+        end = len(pms)
+    requested_cpu = vm["requested"]["cpu"] - FREE_CAPACITY_TOLERANCE
+    requested_memory = vm["requested"]["memory"] - FREE_CAPACITY_TOLERANCE
+
+    # Depth-first search, left child first, skipping nodes without enough free capacity
+    stack = [(1, 0, index["size"])]
+    while stack:
+        node, low, high = stack.pop()
+        if (
+            low >= end
+            or free_cpu[node] < requested_cpu
+            or free_memory[node] < requested_memory
+        ):
+            continue
+        if high - low == 1:
+            pm = pms[low]
+            if vm_fits_on_pm(vm, pm):
+                return low
+            continue
+        middle = (low + high) // 2
+        stack.append((2 * node + 1, middle, high))
+        stack.append((2 * node, low, middle))
+
+    return None
+
+
+def find_best_fit(index, vm):
+    # Position of the most loaded PM with room for the VM, None if there is none
+    pms = index["pms"]
+    size = index["size"]
+    free_cpu = index["free_cpu"]
+    free_memory = index["free_memory"]
+    load_rank = index["load_rank"]
+    requested_cpu = vm["requested"]["cpu"] - FREE_CAPACITY_TOLERANCE
+    requested_memory = vm["requested"]["memory"] - FREE_CAPACITY_TOLERANCE
+
+    # A running VM only moves to a PM ranked before its own one
+    own_position = index["positions"].get(vm["run"]["pm"])
+    own_rank = load_rank[size + own_position] if own_position is not None else None
+
+    # Best-first search on the min load rank of each node
+    heap = [(load_rank[1], 1)]
+    while heap:
+        _, node = heapq.heappop(heap)
+        if (
+            free_cpu[node] < requested_cpu
+            or free_memory[node] < requested_memory
+            or (own_rank is not None and load_rank[node] >= own_rank)
+        ):
+            continue
+        if node >= size:
+            pm = pms[node - size]
+            if vm_fits_on_pm(vm, pm):
+                return node - size
+            continue
+        for child in (2 * node, 2 * node + 1):
+            heapq.heappush(heap, (load_rank[child], child))
+
+    return None
+
+
+def place_vm(index, vm, position):
+    pm = index["pms"][position]
+    pm["s"]["load"]["cpu"] += vm["requested"]["cpu"] / pm["capacity"]["cpu"]
+    pm["s"]["load"]["memory"] += vm["requested"]["memory"] / pm["capacity"]["memory"]
+    update_placement_index(index, position)
+    return pm
+
+
+def build_indexed_heap(keys):
+    # Binary heap of (key, item), lowest key first, with the position of each item
+    heap = sorted((key, item) for item, key in keys.items())
+    return {
+        "heap": heap,
+        "positions": {item: position for position, (_, item) in enumerate(heap)},
+    }
+
+
+def swap_heap_entries(indexed_heap, first, second):
+    heap = indexed_heap["heap"]
+    heap[first], heap[second] = heap[second], heap[first]
+    indexed_heap["positions"][heap[first][1]] = first
+    indexed_heap["positions"][heap[second][1]] = second
+
+
+def update_indexed_heap(indexed_heap, item, key):
+    heap = indexed_heap["heap"]
+    position = indexed_heap["positions"][item]
+    heap[position] = (key, item)
+
+    # Sift up if the key decreased
+    while position > 0:
+        parent = (position - 1) // 2
+        if heap[parent] <= heap[position]:
+            break
+        swap_heap_entries(indexed_heap, parent, position)
+        position = parent
+
+    # Sift down if the key increased
+    while True:
+        smallest = position
+        for child in (2 * position + 1, 2 * position + 2):
+            if child < len(heap) and heap[child] < heap[smallest]:
+                smallest = child
+        if smallest == position:
+            break
+        swap_heap_entries(indexed_heap, smallest, position)
+        position = smallest
+
+
+def iterate_indexed_heap(indexed_heap):
+    # Items in key order, visiting only as much of the heap as is consumed
+    heap = indexed_heap["heap"]
+    if not heap:
+        return
+    frontier = [(heap[0], 0)]
+    while frontier:
+        entry, position = heapq.heappop(frontier)
+        yield entry[1]
+        for child in (2 * position + 1, 2 * position + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+
+def get_bin_packing_lower_bound(sizes, capacity):
+    # Martello-Toth L2 bound on the number of bins, at least the L1 bound ceil(sum / capacity)
+    sizes = [size for size in sizes if size > 0]
+    if not sizes:
+        return 0
+    lower_bound = -(-sum(sizes) // capacity)
+    for threshold in {size for size in sizes if 2 * size <= capacity}:
+        large = [size for size in sizes if size > capacity - threshold]
+        medium = [
+            size for size in sizes if capacity - threshold >= size and 2 * size > capacity
+        ]
+        small = sum(size for size in sizes if 2 * size <= capacity and size >= threshold)
+        free_in_medium = len(medium) * capacity - sum(medium)
+        lower_bound = max(
+            lower_bound,
+            len(large) + len(medium) + max(0, -(-(small - free_in_medium) // capacity)),
+        )
+    return lower_bound
+
+
+def get_vector_packing_lower_bound(vms, capacity):
+    # Each dimension alone gives a valid bound for identical bins
+    return max(
+        get_bin_packing_lower_bound(
+            [vm["requested"]["cpu"] for vm in vms], capacity["cpu"]
+        ),
+        get_bin_packing_lower_bound(
+            [vm["requested"]["memory"] for vm in vms], capacity["memory"]
+        ),
+    )
+
+
+def first_fit_decreasing(vms, pms):
+    # VM ID -> PM ID, largest VMs first on the PMs in order, None if a VM does not fit
+    if not pms:
+        return None if vms else {}
+    free_capacity = [list(get_free_capacity(pm)) for pm in pms]
+    sorted_vms = sorted(
+        vms,
+        key=lambda vm: max(
+            vm["requested"]["cpu"] / pms[0]["capacity"]["cpu"],
+            vm["requested"]["memory"] / pms[0]["capacity"]["memory"],
+        ),
+        reverse=True,
+    )
+
+    assignment = {}
+    for vm in sorted_vms:
+        for position, free in enumerate(free_capacity):
+            if (
+                vm["requested"]["cpu"] <= free[0] + FREE_CAPACITY_TOLERANCE
+                and vm["requested"]["memory"] <= free[1] + FREE_CAPACITY_TOLERANCE
+            ):
+                free[0] -= vm["requested"]["cpu"]
+                free[1] -= vm["requested"]["memory"]
+                assignment[vm["id"]] = pms[position]["id"]
+                break
+        else:
+            return None
+
+    return assignment
+
+
+def can_pms_host_vms(vms, pms):
+    # Necessary conditions for packing: total free capacity and room for the largest VMs
+    free_capacity = [get_free_capacity(pm) for pm in pms]
+    free_capacity = [free for free in free_capacity if free[0] > -inf]
+    if not vms:
+        return True
+    if not free_capacity:
+        return False
+
+    requested_cpu = [vm["requested"]["cpu"] for vm in vms]
+    requested_memory = [vm["requested"]["memory"] for vm in vms]
+    return (
+        sum(requested_cpu)
+        <= sum(free[0] for free in free_capacity) + FREE_CAPACITY_TOLERANCE
+        and sum(requested_memory)
+        <= sum(free[1] for free in free_capacity) + FREE_CAPACITY_TOLERANCE
+        and max(requested_cpu)
+        <= max(free[0] for free in free_capacity) + FREE_CAPACITY_TOLERANCE
+        and max(requested_memory)
+        <= max(free[1] for free in free_capacity) + FREE_CAPACITY_TOLERANCE
+    )
@@ -2,10 +2,28 @@ import os
 import time
 
 from allocation import get_non_allocated_workload, get_pms_on_schedule, run_opl_model
-from config import PM_MANAGER_INPUT_FOLDER_PATH, PM_MANAGER_OUTPUT_FOLDER_PATH
+from config import (
+    PM_MANAGER_FAST_PATH,
+    PM_MANAGER_INPUT_FOLDER_PATH,
+    PM_MANAGER_OUTPUT_FOLDER_PATH,
+)
 from filter import sort_key_energy_intensity_capacity, split_dict_sorted
 from log import log_performance
 from micro import parse_micro_opl_output, save_micro_model_input_format
+from placement import (
+    first_fit_decreasing,
+    get_vector_packing_lower_bound,
+    vm_fits_on_pm,
+)
+from utils import (
+    evaluate_piecewise_linear_function,
+    get_opl_return_code,
+    is_opl_output_valid,
+)
+from weights import price, pue, w_load_cpu
+
+# PM chosen in the last step for each VM waiting for its PM to turn on, used as a warm start
+previous_pm_manager_allocation = {}
 
 try:
     profile  # type: ignore
@@ -41,6 +59,58 @@ def allocate_vms(
     return vms_to_deallocate_in_subset
 
 
+def is_packing_profitable(assignment, vms, pms, energy_intensity_database):
+    # Every PM turned on has to earn more from its VMs than it costs in energy
+    for pm_id, pm in pms.items():
+        vm_ids = [
+            vm_id
+            for vm_id, assigned_pm_id in assignment.items()
+            if assigned_pm_id == pm_id
+        ]
+        if not vm_ids:
+            continue
+        cpu = sum(vms[vm_id]["requested"]["cpu"] for vm_id in vm_ids)
+        memory = sum(vms[vm_id]["requested"]["memory"] for vm_id in vm_ids)
+        load = w_load_cpu * cpu / pm["capacity"]["cpu"] + (1 - w_load_cpu) * (
+            memory / pm["capacity"]["memory"]
+        )
+        energy_cost = (
+            pue
+            * price["energy"]
+            * evaluate_piecewise_linear_function(
+                energy_intensity_database[pm["type"]], min(load, 1.0)
+            )
+        )
+        if cpu * price["cpu"] + memory * price["memory"] < energy_cost:
+            return False
+    return True
+
+
+def solve_pm_manager_by_packing(vms, pms, energy_intensity_database):
+    # Greedy allocation when it provably turns on the fewest identical empty PMs, None otherwise
+    pm_list = list(pms.values())
+    first_pm = pm_list[0]
+    if any(
+        pm["type"] != first_pm["type"]
+        or pm["capacity"] != first_pm["capacity"]
+        or pm["s"]["load"]["cpu"] > 0
+        or pm["s"]["load"]["memory"] > 0
+        for pm in pm_list
+    ):
+        return None
+
+    lower_bound = get_vector_packing_lower_bound(vms.values(), first_pm["capacity"])
+    if lower_bound > len(pm_list):
+        return None
+
+    assignment = first_fit_decreasing(list(vms.values()), pm_list[:lower_bound])
+    if assignment is None or not is_packing_profitable(
+        assignment, vms, pms, energy_intensity_database
+    ):
+        return None
+    return assignment
+
+
 def pm_manager(
     non_allocated_vms,
     physical_machines_off,
@@ -53,9 +123,44 @@ def pm_manager(
     pm_manager_input_folder_path=PM_MANAGER_INPUT_FOLDER_PATH,
     pm_manager_output_folder_path=PM_MANAGER_OUTPUT_FOLDER_PATH,
 ):
+    num_vms = len(non_allocated_vms)
+    num_pms = len(physical_machines_off)
+
+    # Skip the solver when first-fit decreasing reaches the bin packing lower bound
+    if PM_MANAGER_FAST_PATH:
+        start_time_packing = time.time()
+        assignment = solve_pm_manager_by_packing(
+            non_allocated_vms, physical_machines_off, energy_intensity_database
+        )
+        if assignment is not None:
+            vm_ids = list(assignment.keys())
+            pm_ids = list(physical_machines_off.keys())
+            allocation = [
+                [int(assignment[vm_id] == pm_id) for pm_id in pm_ids]
+                for vm_id in vm_ids
+            ]
+            vms_to_deallocate_in_subset = allocate_vms(
+                vm_ids,
+                pm_ids,
+                allocation,
+                non_allocated_vms,
+                physical_machines_off,
+                is_on,
+                time_step,
+            )
+            log_performance(
+                step,
+                "pm_manager",
+                time.time() - start_time_packing,
+                "bin packing",
+                num_vms,
+                num_pms,
+                performance_log_file,
+            )
+            return vms_to_deallocate_in_subset
 
     # Convert into model input format
-    micro_vm_model_input_file_path, micro_pm_model_input_file_path = (
+    micro_vm_model_input_file_path, micro_pm_model_input_file_path, vm_classes = (
         save_micro_model_input_format(
             non_allocated_vms,
             physical_machines_off,
@@ -63,12 +168,10 @@ def pm_manager(
             pm_manager_input_folder_path,
             energy_intensity_database,
             nb_points,
+            previous_pm_manager_allocation,
         )
     )
 
-    num_vms = len(non_allocated_vms)
-    num_pms = len(physical_machines_off)
-
     start_time_opl = time.time()
     opl_output = run_opl_model(
         micro_vm_model_input_file_path,
@@ -80,8 +183,23 @@ def pm_manager(
     )
     end_time_opl = time.time()
 
+    # No incumbent within the time limit, or one with too large a gap
+    if opl_output is None or not is_opl_output_valid(
+        opl_output, get_opl_return_code(opl_output)
+    ):
+        log_performance(
+            step,
+            "pm_manager",
+            end_time_opl - start_time_opl,
+            "not valid",
+            num_vms,
+            num_pms,
+            performance_log_file,
+        )
+        return []
+
     # Parse OPL output and reallocate VMs
-    parsed_data = parse_micro_opl_output(opl_output)
+    parsed_data = parse_micro_opl_output(opl_output, vm_classes)
     partial_allocation = parsed_data.get("allocation")
     vm_ids = parsed_data["vm_ids"]
     pm_ids = parsed_data["pm_ids"]
@@ -172,55 +290,42 @@ def launch_pm_manager(
         else:
             physical_machines_off_subsets = [physical_machines_off]
 
-        num_non_allocated_vms = 0
-
         for index, pm_subset in enumerate(physical_machines_off_subsets):
-            # If no new VMs were allocated, include immediately bigger PMs
-            if num_non_allocated_vms == len(non_allocated_vms):
-                min_vm_cpu = min(
-                    vm["requested"]["cpu"] for vm in non_allocated_vms.values()
-                )
-                min_vm_memory = min(
-                    vm["requested"]["memory"] for vm in non_allocated_vms.values()
-                )
-                # If in the next subset there is no PM that can host the smallest VM, skip this subset
-                if not any(
-                    pm["capacity"]["cpu"] >= min_vm_cpu
-                    and pm["capacity"]["memory"] >= min_vm_memory
-                    for pm in pm_subset.values()
-                ):
-                    continue  # Skip this subset if no PM can host the smallest VM
-
-            num_non_allocated_vms = len(non_allocated_vms)
-            if num_non_allocated_vms:
-                pm_manager_input_folder_path = os.path.join(
-                    input_folder_path, f"step_{step}/subset_{index}"
-                )
-                pm_manager_output_folder_path = os.path.join(
-                    output_folder_path, f"step_{step}/subset_{index}"
-                )
-
-                os.makedirs(pm_manager_input_folder_path, exist_ok=True)
-                os.makedirs(pm_manager_output_folder_path, exist_ok=True)
-
-                # Call the scaling manager
-                vms_to_deallocate_in_subset = pm_manager(
-                    non_allocated_vms,
-                    pm_subset,
-                    step,
-                    energy_intensity_database,
-                    nb_points,
-                    performance_log_file,
-                    is_on,
-                    time_step,
-                    pm_manager_input_folder_path,
-                    pm_manager_output_folder_path,
-                )
-                vms_to_deallocate.extend(vms_to_deallocate_in_subset)
-
-            else:
+            if not non_allocated_vms:
                 break
 
+            # Skip the subset if no PM in it can host any of the pending VMs
+            if not any(
+                vm_fits_on_pm(vm, pm)
+                for pm in pm_subset.values()
+                for vm in non_allocated_vms.values()
+            ):
+                continue
+
+            pm_manager_input_folder_path = os.path.join(
+                input_folder_path, f"step_{step}/subset_{index}"
+            )
+            pm_manager_output_folder_path = os.path.join(
+                output_folder_path, f"step_{step}/subset_{index}"
+            )
+
+            # Call the scaling manager
+            vms_to_deallocate_in_subset = pm_manager(
+                non_allocated_vms,
+                pm_subset,
+                step,
+                energy_intensity_database,
+                nb_points,
+                performance_log_file,
+                is_on,
+                time_step,
+                pm_manager_input_folder_path,
+                pm_manager_output_folder_path,
+            )
+            vms_to_deallocate.extend(vms_to_deallocate_in_subset)
+
+        previous_pm_manager_allocation.clear()
         for vm_id in vms_to_deallocate:
             vm = active_vms.get(vm_id)
+            previous_pm_manager_allocation[vm_id] = vm["allocation"]["pm"]
             vm["allocation"]["pm"] = -1
@@ -2,6 +2,7 @@ import csv
 import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from colorama import Fore
@@ -43,18 +44,35 @@ from check import (
     check_zero_load,
 )
 from config import (
+    EPGAP_MICRO,
+    CONSOLIDATION_FRAGMENTATION_THRESHOLD,
+    CONSOLIDATION_LIGHT_LOAD,
+    CONSOLIDATION_ON_FRAGMENTATION,
+    CONSOLIDATION_SAVINGS_HORIZON,
+    MICRO_BACKLOG_ADMITTED_VMS,
+    MICRO_BACKLOG_CONTROL,
+    MICRO_BACKLOG_HIGH,
+    MICRO_BACKLOG_LOW,
+    MICRO_BACKLOG_MIN_HEURISTIC_RUNS,
+    MICRO_BACKLOG_MIN_SUCCESS_RATE,
+    MICRO_BACKLOG_SUCCESS_WINDOW,
+    MIGRATION_MODEL_FAST_PATH,
     MIGRATION_MODEL_INPUT_FOLDER_PATH,
     MIGRATION_MODEL_OUTPUT_FOLDER_PATH,
     MICRO_MODEL_INPUT_FOLDER_PATH,
     MICRO_MODEL_OUTPUT_FOLDER_PATH,
+    MICRO_MODEL_PARALLEL_SOLVES,
+    MICRO_MODEL_SOLVER,
     MACRO_MODEL_INPUT_FOLDER_PATH,
     MACRO_MODEL_OUTPUT_FOLDER_PATH,
     OUTPUT_FOLDER_PATH,
+    PHASE_INVALIDATING_EVENTS,
     SAVE_VM_AND_PM_SETS,
 )
 from data_generator import generate_new_vms
 from filter import (
-    filter_fragmented_pms,
+    build_fragmentation_queue,
+    co_partition_vms_and_pms,
     filter_full_and_migrating_pms,
     filter_full_pms_dict,
     filter_migrating_pms,
@@ -62,23 +80,33 @@ from filter import (
     filter_vms_on_pms,
     filter_vms_on_pms_and_non_allocated,
     get_fragmented_pms_list,
+    get_migration_candidate_pms,
+    get_migrating_pm_ids,
     is_pm_full,
+    pop_fragmented_pms,
     sort_key_load,
     sort_key_energy_intensity_load,
+    sort_backlog_by_revenue,
+    split_backlog_by_revenue,
     split_dict_sorted,
-    split_dict_unsorted,
+    split_fixed_vms,
 )
 from log import log_allocation, log_performance, log_vm_execution_time
 from micro import (
     micro_reallocate_vms,
     parse_micro_opl_output,
+    reduce_interchangeable_pms,
     save_micro_model_input_format,
+    solve_micro_model_with_highs,
 )
+from placement import can_pms_host_vms, first_fit_decreasing
 from pm_manager import launch_pm_manager
 from utils import (
     color_text,
     evaluate_piecewise_linear_function,
     get_opl_return_code,
+    is_highs_result_valid,
+    is_opl_output_optimal,
     is_opl_output_valid,
     load_new_vms,
     parse_opl_output,
@@ -86,7 +114,32 @@ from utils import (
     save_pm_sets,
     save_vm_sets,
 )
-from weights import w_load_cpu, EPSILON
+from weights import price, pue, w_load_cpu, EPSILON
+
+# Fingerprint of each macro subset whose last solve was optimal and changed nothing
+unchanged_macro_subsets = {}
+
+# Loads of the candidate PMs after the last load balancing, PM ID -> (cpu, memory)
+last_balanced_loads = {}
+
+# Placement of the micro phase ("solver" or "heuristic"), runs since the last switch and recent solve outcomes
+micro_backlog_controller = {"mode": "solver", "runs_in_mode": 0, "solve_outcomes": []}
+
+# Phases of the pipeline run by each algorithm
+ALGORITHM_PHASES = {
+    "maxi": ("macro",),
+    "mini": ("micro",),
+    "hybrid": ("micro", "macro"),
+    "compound": ("micro", "migration"),
+    "multilayer": ("micro", "migration", "load_balancer"),
+    "backup": ("placement",),
+    "best_fit": ("placement",),
+    "first_fit": ("placement",),
+    "shi_OM": ("placement",),
+    "shi_AC": ("placement",),
+    "shi_PU": ("placement",),
+    "lago": ("placement",),
+}
 
 try:
     profile  # type: ignore
@@ -117,19 +170,24 @@ def run_macro_model(
     algorithm,
 ):
     pms_with_migrations = {}
+    solved_to_optimality = False
 
-    num_vms = len(vms)
+    # VMs the model cannot move only add a fixed load to their PMs
+    movable_vms, fixed_vms_on_pms = split_fixed_vms(vms, highest_fragmentation_pms)
+
+    num_vms = len(movable_vms)
     num_pms = len(highest_fragmentation_pms)
 
     if num_vms > 0 and num_pms > 0:
         # Convert into model input format
         vm_model_input_file_path, pm_model_input_file_path = save_model_input_format(
-            vms,
+            movable_vms,
             highest_fragmentation_pms,
             step,
             MACRO_MODEL_INPUT_FOLDER_PATH,
             energy_intensity_database,
             nb_points,
+            fixed_vms_on_pms,
         )
 
         # Run CPLEX model
@@ -161,6 +219,7 @@ def run_macro_model(
 
             opl_return_code = get_opl_return_code(opl_output)
             opl_output_valid = is_opl_output_valid(opl_output, opl_return_code)
+            solved_to_optimality = is_opl_output_optimal(opl_output, opl_return_code)
 
         if opl_output_valid:
             # Parse OPL output and reallocate VMs
@@ -257,6 +316,35 @@ def run_macro_model(
                     performance_log_file,
                 )
 
+    return solved_to_optimality
+
+
+def get_macro_subset_fingerprint(vms, pms):
+    # PM states and loads and VM placements of a macro subset, the time progress aside
+    return (
+        tuple(
+            (
+                pm_id,
+                pm["s"]["state"],
+                pm["s"]["time_to_turn_on"],
+                pm["s"]["time_to_turn_off"],
+                pm["s"]["load"]["cpu"],
+                pm["s"]["load"]["memory"],
+            )
+            for pm_id, pm in pms.items()
+        ),
+        frozenset(
+            (
+                vm_id,
+                vm["allocation"]["pm"],
+                vm["run"]["pm"],
+                vm["migration"]["from_pm"],
+                vm["migration"]["to_pm"],
+            )
+            for vm_id, vm in vms.items()
+        ),
+    )
+
 
 def launch_macro_model(
     active_vms,
@@ -278,42 +366,73 @@ def launch_macro_model(
     algorithm,
 ):
     physical_machines = physical_machines_on.copy()
+    solved_macro_subsets = {}
+
+    # New migrations only involve the PMs of a solved subset, which are dropped afterwards
+    migrating_pm_ids = get_migrating_pm_ids(active_vms)
+    fragmentation_queue = None
 
     for _ in range(macro_model_max_subsets):
         if physical_machines_on:
-            filter_full_and_migrating_pms(active_vms, physical_machines_on)
+            filter_full_and_migrating_pms(
+                active_vms, physical_machines_on, migrating_pm_ids
+            )
             if physical_machines_on:
-                highest_fragmentation_pms = filter_fragmented_pms(
-                    physical_machines_on, macro_model_max_pms
+                if fragmentation_queue is None:
+                    fragmentation_queue = build_fragmentation_queue(
+                        physical_machines_on
+                    )
+                highest_fragmentation_pms = pop_fragmented_pms(
+                    fragmentation_queue, physical_machines_on, macro_model_max_pms
                 )
                 filtered_vms = filter_vms_on_pms_and_non_allocated(
                     active_vms, highest_fragmentation_pms, scheduled_vms
                 )
                 if filtered_vms:
-                    run_macro_model(
-                        filtered_vms,
-                        highest_fragmentation_pms,
-                        physical_machines,
-                        scheduled_vms,
-                        pms_to_turn_off_after_migration,
-                        micro_model_max_pms,
-                        micro_model_max_vms,
-                        step,
-                        time_step,
-                        MACRO_MODEL_INPUT_FOLDER_PATH,
-                        idle_power,
-                        energy_intensity_database,
-                        nb_points,
-                        hard_time_limit_macro,
-                        hard_time_limit_micro,
-                        performance_log_file,
-                        algorithm,
+                    # Skip subsets unchanged since a solve that left them as they were
+                    subset_key = frozenset(highest_fragmentation_pms.keys())
+                    fingerprint = get_macro_subset_fingerprint(
+                        filtered_vms, highest_fragmentation_pms
                     )
+                    if unchanged_macro_subsets.get(subset_key) == fingerprint:
+                        solved_macro_subsets[subset_key] = fingerprint
+                    else:
+                        solved_to_optimality = run_macro_model(
+                            filtered_vms,
+                            highest_fragmentation_pms,
+                            physical_machines,
+                            scheduled_vms,
+                            pms_to_turn_off_after_migration,
+                            micro_model_max_pms,
+                            micro_model_max_vms,
+                            step,
+                            time_step,
+                            MACRO_MODEL_INPUT_FOLDER_PATH,
+                            idle_power,
+                            energy_intensity_database,
+                            nb_points,
+                            hard_time_limit_macro,
+                            hard_time_limit_micro,
+                            performance_log_file,
+                            algorithm,
+                        )
+                        if (
+                            solved_to_optimality
+                            and get_macro_subset_fingerprint(
+                                filtered_vms, highest_fragmentation_pms
+                            )
+                            == fingerprint
+                        ):
+                            solved_macro_subsets[subset_key] = fingerprint
                 for pm_id in list(highest_fragmentation_pms.keys()):
                     del physical_machines_on[pm_id]
             else:
                 break
 
+    # Keep only the subsets seen in this step
+    unchanged_macro_subsets.clear()
+    unchanged_macro_subsets.update(solved_macro_subsets)
+
 
 
 def run_micro_model(
@@ -329,55 +448,85 @@ def run_micro_model(
     nb_points,
     hard_time_limit_micro,
     performance_log_file,
+    data_folder_path=None,
 ):
-    # Convert into model input format
-    micro_vm_model_input_file_path, micro_pm_model_input_file_path = (
-        save_micro_model_input_format(
-            non_allocated_vms,
-            physical_machines_on,
-            step,
-            micro_model_input_folder_path,
-            energy_intensity_database,
-            nb_points,
-        )
-    )
+    # Drop interchangeable PMs that no solution could use
+    model_pms = reduce_interchangeable_pms(non_allocated_vms, physical_machines_on)
 
     num_vms = len(non_allocated_vms)
-    num_pms = len(physical_machines_on)
-
-    # Run CPLEX model
-    print(color_text(f"\nRunning micro model for time step {step}...", Fore.YELLOW))
-    start_time_opl = time.time()
-    opl_output = run_opl_model(
-        micro_vm_model_input_file_path,
-        micro_pm_model_input_file_path,
-        MICRO_MODEL_INPUT_FOLDER_PATH,
-        micro_model_output_folder_path,
-        step,
-        "micro",
-        hard_time_limit_micro,
-    )
-    end_time_opl = time.time()
+    num_pms = len(model_pms)
 
-    if opl_output is None:
+    if MICRO_MODEL_SOLVER == "highs":
+        # Solve in memory, without input files nor oplrun
         print(
             color_text(
-                f"\nOPL micro model run exceeded time limit of {hard_time_limit_micro} seconds. Exiting.",
-                Fore.RED,
+                f"\nRunning micro model with HiGHS for time step {step}...", Fore.YELLOW
             )
         )
-        opl_output_valid = False
+        start_time_opl = time.time()
+        parsed_data, highs_status, highs_mip_gap = solve_micro_model_with_highs(
+            non_allocated_vms,
+            model_pms,
+            energy_intensity_database,
+            hard_time_limit_micro,
+            EPGAP_MICRO,
+        )
+        end_time_opl = time.time()
+        opl_output_valid = is_highs_result_valid(
+            parsed_data, highs_status, highs_mip_gap
+        )
     else:
+        # Convert into model input format
+        micro_vm_model_input_file_path, micro_pm_model_input_file_path, vm_classes = (
+            save_micro_model_input_format(
+                non_allocated_vms,
+                model_pms,
+                step,
+                micro_model_input_folder_path,
+                energy_intensity_database,
+                nb_points,
+            )
+        )
+
+        # Run CPLEX model
         print(
-            f"\nTime taken to run micro model: {end_time_opl - start_time_opl} seconds"
+            color_text(f"\nRunning micro model for time step {step}...", Fore.YELLOW)
         )
+        start_time_opl = time.time()
+        opl_output = run_opl_model(
+            micro_vm_model_input_file_path,
+            micro_pm_model_input_file_path,
+            MICRO_MODEL_INPUT_FOLDER_PATH,
+            micro_model_output_folder_path,
+            step,
+            "micro",
+            hard_time_limit_micro,
+            data_folder_path,
+        )
+        end_time_opl = time.time()
+
+        if opl_output is None:
+            print(
+                color_text(
+                    f"\nOPL micro model run exceeded time limit of {hard_time_limit_micro} seconds. Exiting.",
+                    Fore.RED,
+                )
+            )
+            opl_output_valid = False
+        else:
+            print(
+                f"\nTime taken to run micro model: {end_time_opl - start_time_opl} seconds"
+            )
+
+            opl_return_code = get_opl_return_code(opl_output)
+            opl_output_valid = is_opl_output_valid(opl_output, opl_return_code)
 
-        opl_return_code = get_opl_return_code(opl_output)
-        opl_output_valid = is_opl_output_valid(opl_output, opl_return_code)
+        if opl_output_valid:
+            # Parse OPL output
+            parsed_data = parse_micro_opl_output(opl_output, vm_classes)
 
     if opl_output_valid:
-        # Parse OPL output and reallocate VMs
-        parsed_data = parse_micro_opl_output(opl_output)
+        # Reallocate VMs
         partial_allocation = parsed_data.get("allocation")
         vm_ids = parsed_data["vm_ids"]
         pm_ids = parsed_data["pm_ids"]
@@ -405,10 +554,84 @@ def run_micro_model(
             num_pms,
             performance_log_file,
         )
+        # Only the VMs of this subset, concurrent subsets place their own
         run_backup_allocation(
-            active_vms, physical_machines_on, idle_power, step, time_step
+            non_allocated_vms, physical_machines_on, idle_power, step, time_step
         )
 
+    return opl_output_valid
+
+
+def record_micro_solve_outcome(is_success):
+    solve_outcomes = micro_backlog_controller["solve_outcomes"]
+    solve_outcomes.append(is_success)
+    del solve_outcomes[:-MICRO_BACKLOG_SUCCESS_WINDOW]
+
+
+def update_micro_backlog_controller(num_pending_vms, step):
+    # Switch to the heuristic on a large backlog or failing solves, back once the backlog is small again
+    controller = micro_backlog_controller
+    solve_outcomes = controller["solve_outcomes"]
+    success_rate = sum(solve_outcomes) / len(solve_outcomes) if solve_outcomes else 1.0
+    controller["runs_in_mode"] += 1
+
+    if controller["mode"] == "solver":
+        if (
+            num_pending_vms > MICRO_BACKLOG_HIGH
+            or success_rate < MICRO_BACKLOG_MIN_SUCCESS_RATE
+        ):
+            controller["mode"] = "heuristic"
+            controller["runs_in_mode"] = 0
+            print(
+                color_text(
+                    f"\nMicro backlog of {num_pending_vms} VMs with solve success rate {success_rate:.2f}, switching to heuristic placement at time step {step}...",
+                    Fore.YELLOW,
+                )
+            )
+    elif (
+        num_pending_vms <= MICRO_BACKLOG_LOW
+        and controller["runs_in_mode"] >= MICRO_BACKLOG_MIN_HEURISTIC_RUNS
+    ):
+        controller["mode"] = "solver"
+        controller["runs_in_mode"] = 0
+        solve_outcomes.clear()
+        print(
+            color_text(
+                f"\nMicro backlog down to {num_pending_vms} VMs, switching back to the micro model at time step {step}...",
+                Fore.YELLOW,
+            )
+        )
+
+    return controller["mode"]
+
+
+def run_micro_heuristic(
+    non_allocated_vms,
+    physical_machines_on,
+    pms_to_turn_off_after_migration,
+    step,
+    time_step,
+    idle_power,
+    performance_log_file,
+):
+    start_time_heuristic = time.time()
+    filter_full_pms_dict(physical_machines_on)
+    filter_pms_to_turn_off_after_migration(
+        physical_machines_on, pms_to_turn_off_after_migration
+    )
+    run_backup_allocation(
+        non_allocated_vms, physical_machines_on, idle_power, step, time_step
+    )
+    end_time_heuristic = time.time()
+    log_performance(
+        step,
+        "backlog",
+        end_time_heuristic - start_time_heuristic,
+        "",
+        len(non_allocated_vms),
+        len(physical_machines_on),
+        performance_log_file,
+    )
 
 
 def launch_micro_model(
@@ -427,79 +650,131 @@ def launch_micro_model(
     hard_time_limit_micro,
     performance_log_file,
 ):
-    if non_allocated_vms:
-        if micro_model_max_vms and len(non_allocated_vms) > micro_model_max_vms:
-            non_allocated_vms_subsets = split_dict_unsorted(
-                non_allocated_vms, micro_model_max_vms
+    # Admit the backlog by revenue, all of it to the heuristic during surges
+    overflow_vms = {}
+    if MICRO_BACKLOG_CONTROL and non_allocated_vms:
+        mode = update_micro_backlog_controller(len(non_allocated_vms), step)
+        if mode == "heuristic":
+            non_allocated_vms = sort_backlog_by_revenue(non_allocated_vms)
+            run_micro_heuristic(
+                non_allocated_vms,
+                physical_machines_on,
+                pms_to_turn_off_after_migration,
+                step,
+                time_step,
+                idle_power,
+                performance_log_file,
             )
-        else:
-            non_allocated_vms_subsets = [non_allocated_vms]
+            return
+        non_allocated_vms, overflow_vms = split_backlog_by_revenue(
+            non_allocated_vms, MICRO_BACKLOG_ADMITTED_VMS
+        )
 
-        for non_allocated_vms_subset in non_allocated_vms_subsets:
-            filter_full_pms_dict(physical_machines_on)
-            filter_pms_to_turn_off_after_migration(
-                physical_machines_on, pms_to_turn_off_after_migration
-            )
+    # As many rounds as VM chunks, each solve is bounded by hard_time_limit_micro
+    max_rounds = (
+        math.ceil(len(non_allocated_vms) / micro_model_max_vms)
+        if micro_model_max_vms
+        else 1
+    )
 
-            if physical_machines_on:
-                # Determine PM subset
-                if (
-                    micro_model_max_pms
-                    and len(physical_machines_on) > micro_model_max_pms
-                ):
-                    physical_machines_on_subsets = split_dict_sorted(
-                        physical_machines_on,
-                        micro_model_max_pms,
-                        sort_key_energy_intensity_load,
-                        energy_intensity_database,
-                    )
-                else:
-                    physical_machines_on_subsets = [physical_machines_on]
+    subset_index = 0
+    for _ in range(max_rounds):
+        if not non_allocated_vms:
+            break
+        filter_full_pms_dict(physical_machines_on)
+        filter_pms_to_turn_off_after_migration(
+            physical_machines_on, pms_to_turn_off_after_migration
+        )
+        if not physical_machines_on:
+            break
 
-                for index, pm_subset in enumerate(physical_machines_on_subsets):
-                    if index != 0:
-                        non_allocated_vms = get_non_allocated_workload(
-                            non_allocated_vms_subset, scheduled_vms
-                        )
-                    else:
-                        non_allocated_vms = non_allocated_vms_subset
+        # Determine PM subsets
+        if micro_model_max_pms and len(physical_machines_on) > micro_model_max_pms:
+            physical_machines_on_subsets = split_dict_sorted(
+                physical_machines_on,
+                micro_model_max_pms,
+                sort_key_energy_intensity_load,
+                energy_intensity_database,
+            )
+        else:
+            physical_machines_on_subsets = [physical_machines_on]
 
-                    if non_allocated_vms:
-                        micro_model_input_folder_path = os.path.join(
-                            MICRO_MODEL_INPUT_FOLDER_PATH, f"step_{step}/subset_{index}"
-                        )
-                        micro_model_output_folder_path = os.path.join(
-                            MICRO_MODEL_OUTPUT_FOLDER_PATH,
-                            f"step_{step}/subset_{index}",
-                        )
+        # Give each PM subset the pending VMs it has room for, so every solve is feasible
+        subsets = co_partition_vms_and_pms(
+            non_allocated_vms, physical_machines_on_subsets, micro_model_max_vms
+        )
+        if not subsets:
+            break
 
-                        os.makedirs(micro_model_input_folder_path, exist_ok=True)
-                        os.makedirs(micro_model_output_folder_path, exist_ok=True)
+        solves = []
+        for position, (vm_subset, pm_subset) in enumerate(subsets):
+            micro_model_input_folder_path = os.path.join(
+                MICRO_MODEL_INPUT_FOLDER_PATH, f"step_{step}/subset_{subset_index}"
+            )
+            micro_model_output_folder_path = os.path.join(
+                MICRO_MODEL_OUTPUT_FOLDER_PATH, f"step_{step}/subset_{subset_index}"
+            )
+            subset_index += 1
 
-                        run_micro_model(
-                            active_vms,
-                            non_allocated_vms,
-                            pm_subset,
-                            step,
-                            time_step,
-                            micro_model_input_folder_path,
-                            micro_model_output_folder_path,
-                            idle_power,
-                            energy_intensity_database,
-                            nb_points,
-                            hard_time_limit_micro,
-                            performance_log_file,
-                        )
+            # Concurrent solves need their own OPL data folder
+            data_folder_path = None
+            if MICRO_MODEL_PARALLEL_SOLVES > 1 and len(subsets) > 1:
+                data_folder_path = os.path.join(
+                    MICRO_MODEL_INPUT_FOLDER_PATH, f"worker_{position}"
+                )
 
-                        # Calculate and update load
-                        cpu_load, memory_load = calculate_load(
-                            pm_subset, active_vms, time_step
-                        )
-                        update_physical_machines_load(pm_subset, cpu_load, memory_load)
+            solves.append(
+                (
+                    active_vms,
+                    vm_subset,
+                    pm_subset,
+                    step,
+                    time_step,
+                    micro_model_input_folder_path,
+                    micro_model_output_folder_path,
+                    idle_power,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                    data_folder_path,
+                )
+            )
 
-                    else:
-                        break
+        # The subsets share no VM and no PM, so they can be solved concurrently
+        if MICRO_MODEL_PARALLEL_SOLVES > 1 and len(solves) > 1:
+            with ThreadPoolExecutor(max_workers=MICRO_MODEL_PARALLEL_SOLVES) as executor:
+                futures = [executor.submit(run_micro_model, *solve) for solve in solves]
+                outcomes = [future.result() for future in futures]
+        else:
+            outcomes = [run_micro_model(*solve) for solve in solves]
 
+        # Recorded here, once the workers are done with the shared history
+        for is_success in outcomes:
+            record_micro_solve_outcome(is_success)
+
+        for _, pm_subset in subsets:
+            # Calculate and update load
+            cpu_load, memory_load = calculate_load(pm_subset, active_vms, time_step)
+            update_physical_machines_load(pm_subset, cpu_load, memory_load)
+
+        # Retry the VMs left over, or beyond the subset size, while the rounds make progress
+        remaining_vms = get_non_allocated_workload(non_allocated_vms, scheduled_vms)
+        if len(remaining_vms) == len(non_allocated_vms):
+            break
+        non_allocated_vms = remaining_vms
+
+    # VMs beyond the solver admission are placed by the heuristic
+    if overflow_vms:
+        run_micro_heuristic(
+            overflow_vms,
+            physical_machines_on,
+            pms_to_turn_off_after_migration,
+            step,
+            time_step,
+            idle_power,
+            performance_log_file,
+        )
 
 
 def run_migration_model(
@@ -512,17 +787,34 @@ def run_migration_model(
     nb_points,
     hard_time_limit_migration,
 ):
+    # Settle the evacuation without the solver when first-fit decreasing finds room for every VM
+    if MIGRATION_MODEL_FAST_PATH:
+        start_time_greedy = time.time()
+        destination_pms = sorted(physical_machines_on.values(), key=sort_key_load)
+        assignment = first_fit_decreasing(
+            list(non_allocated_vms.values()), destination_pms
+        )
+        if assignment is not None:
+            vm_ids = list(assignment.keys())
+            pm_ids = list(physical_machines_on.keys())
+            partial_allocation = [
+                [int(assignment[vm_id] == pm_id) for pm_id in pm_ids]
+                for vm_id in vm_ids
+            ]
+            return partial_allocation, vm_ids, pm_ids, time.time() - start_time_greedy
 
     # Convert into model input format
-    migration_vm_model_input_file_path, migration_pm_model_input_file_path = (
-        save_micro_model_input_format(
-            non_allocated_vms,
-            physical_machines_on,
-            step,
-            migration_model_input_folder_path,
-            energy_intensity_database,
-            nb_points,
-        )
+    (
+        migration_vm_model_input_file_path,
+        migration_pm_model_input_file_path,
+        vm_classes,
+    ) = save_micro_model_input_format(
+        non_allocated_vms,
+        physical_machines_on,
+        step,
+        migration_model_input_folder_path,
+        energy_intensity_database,
+        nb_points,
     )
 
     # Run CPLEX model
@@ -538,11 +830,14 @@ def run_migration_model(
     )
     end_time_opl = time.time()
 
-    if opl_output is None:
+    # No incumbent within the time limit
+    if opl_output is None or not is_opl_output_valid(
+        opl_output, get_opl_return_code(opl_output)
+    ):
         return None, None, None, end_time_opl - start_time_opl
 
     # Parse OPL output and reallocate VMs
-    parsed_data = parse_micro_opl_output(opl_output)
+    parsed_data = parse_micro_opl_output(opl_output, vm_classes)
     partial_allocation = parsed_data.get("allocation")
     vm_ids = parsed_data.get("vm_ids")
     pm_ids = parsed_data.get("pm_ids")
@@ -566,6 +861,7 @@ def launch_migration_model(
     performance_log_file,
     hard_time_limit_migration,
     failed_migrations_limit=50,
+    migration_model_max_candidate_pms=None,
 ):
     filter_full_and_migrating_pms(active_vms, physical_machines_on)
     fragmented_pms = get_fragmented_pms_list(
@@ -606,6 +902,31 @@ def launch_migration_model(
                 del physical_machines_on_without_pm[pm["id"]]
 
                 if vms_to_allocate and physical_machines_on_without_pm:
+                    # Best candidate PMs, the set is widened on failure
+                    max_candidate_pms = migration_model_max_candidate_pms
+                    candidate_pms = get_migration_candidate_pms(
+                        vms_to_allocate,
+                        physical_machines_on_without_pm,
+                        max_candidate_pms,
+                        energy_intensity_database,
+                    )
+
+                    # Skip evacuations that the other PMs cannot possibly absorb
+                    if not candidate_pms or not can_pms_host_vms(
+                        list(vms_to_allocate.values()),
+                        physical_machines_on_without_pm.values(),
+                    ):
+                        log_performance(
+                            step,
+                            "migration",
+                            0,
+                            "infeasible",
+                            len(vms_to_allocate),
+                            len(physical_machines_on_without_pm),
+                            performance_log_file,
+                        )
+                        continue
+
                     migration_model_input_folder_path = os.path.join(
                         MIGRATION_MODEL_INPUT_FOLDER_PATH, f"step_{step}/pm_{pm["id"]}"
                     )
@@ -613,20 +934,36 @@ def launch_migration_model(
                         MIGRATION_MODEL_OUTPUT_FOLDER_PATH, f"step_{step}/pm_{pm["id"]}"
                     )
 
-                    os.makedirs(migration_model_input_folder_path, exist_ok=True)
-                    os.makedirs(migration_model_output_folder_path, exist_ok=True)
-
-                    # Try to allocate the VMs on the other PMs
-                    partial_allocation, vm_ids, pm_ids, runtime = run_migration_model(
-                        vms_to_allocate,
-                        physical_machines_on_without_pm,
-                        step,
-                        migration_model_input_folder_path,
-                        migration_model_output_folder_path,
-                        energy_intensity_database,
-                        nb_points,
-                        hard_time_limit_migration,
-                    )
+                    # Try to allocate the VMs on the candidate PMs, widening the set on failure
+                    while True:
+                        partial_allocation, vm_ids, pm_ids, runtime = (
+                            run_migration_model(
+                                vms_to_allocate,
+                                candidate_pms,
+                                step,
+                                migration_model_input_folder_path,
+                                migration_model_output_folder_path,
+                                energy_intensity_database,
+                                nb_points,
+                                hard_time_limit_migration,
+                            )
+                        )
+                        if (
+                            partial_allocation is None
+                            or is_allocation_for_all_vms(partial_allocation)
+                            or not max_candidate_pms
+                        ):
+                            break
+                        max_candidate_pms *= 2
+                        wider_candidate_pms = get_migration_candidate_pms(
+                            vms_to_allocate,
+                            physical_machines_on_without_pm,
+                            max_candidate_pms,
+                            energy_intensity_database,
+                        )
+                        if len(wider_candidate_pms) == len(candidate_pms):
+                            break
+                        candidate_pms = wider_candidate_pms
 
                     if partial_allocation is None:
                         log_performance(
@@ -712,6 +1049,15 @@ def run_load_balancer(
     filter_pms_to_turn_off_after_migration(
         physical_machines_on, pms_to_turn_off_after_migration
     )
+
+    # Nothing to balance if the candidate PMs kept their loads since the last run
+    loads = {
+        pm_id: (pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"])
+        for pm_id, pm in physical_machines_on.items()
+    }
+    if loads == last_balanced_loads:
+        return
+
     vms_on_pms = get_vms_on_pms(active_vms, physical_machines_on.keys())
 
     physical_machines_on = list(physical_machines_on.values())
@@ -727,16 +1073,21 @@ def run_load_balancer(
     pm_maxs = reversed(physical_machines_on[-middle_index:])
 
     for pm_max in pm_maxs:
+        # Destinations are the least loaded PMs up to the first almost full one
+        pm_mins = []
         for pm_min in physical_machines_on:
             if (
                 pm_min["s"]["load"]["cpu"] > 1 - EPSILON
                 or pm_min["s"]["load"]["memory"] > 1 - EPSILON
             ):
                 break
-            if pm_max == pm_min:
-                continue
-            vms_on_pm_max = vms_on_pms[pm_max["id"]]
-            load_balancer(vms_on_pm_max, pm_max, pm_min, energy_intensity_database)
+            pm_mins.append(pm_min)
+        vms_on_pm_max = vms_on_pms[pm_max["id"]]
+        load_balancer(vms_on_pm_max, pm_max, pm_mins, energy_intensity_database)
+
+    last_balanced_loads.clear()
+    for pm in physical_machines_on:
+        last_balanced_loads[pm["id"]] = (pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"])
 
     load_balancer_end_time = time.time()
     log_performance(
@@ -845,6 +1196,85 @@ def run_lago(
     return turned_on_pms, turned_off_pms
 
 
+def get_phases_to_run(algorithm, state_events, non_allocated_vms):
+    # Phases of the algorithm invalidated by the events since the last run
+    phases_to_run = {
+        phase
+        for phase in ALGORITHM_PHASES.get(algorithm, ())
+        if state_events.intersection(PHASE_INVALIDATING_EVENTS[phase])
+    }
+    # Allocation has nothing to do without pending workload
+    if not non_allocated_vms:
+        phases_to_run.discard("micro")
+    return phases_to_run
+
+
+def get_pm_fragmentation(pm, time_step):
+    # PMs that are off or empty take no part in consolidation
+    if not is_fully_on_next_step(pm, time_step):
+        return None
+    max_load = max(pm["s"]["load"]["cpu"], pm["s"]["load"]["memory"])
+    if max_load <= 0:
+        return None
+    return 1 - max_load, max_load <= CONSOLIDATION_LIGHT_LOAD
+
+
+def get_fragmentation_index(physical_machines, time_step):
+    # PM ID -> (idle capacity share, is lightly loaded) of the PMs taking part in consolidation
+    pm_fragmentation = {}
+    for pm_id, pm in physical_machines.items():
+        fragmentation = get_pm_fragmentation(pm, time_step)
+        if fragmentation is not None:
+            pm_fragmentation[pm_id] = fragmentation
+    return pm_fragmentation
+
+
+def should_consolidate(active_vms, physical_machines, idle_power, step, time_step):
+    if not CONSOLIDATION_ON_FRAGMENTATION:
+        return True
+
+    pm_fragmentation = get_fragmentation_index(physical_machines, time_step)
+    total_waste = math.fsum(waste for waste, _ in pm_fragmentation.values())
+    num_light_pms = sum(is_light for _, is_light in pm_fragmentation.values())
+    if not num_light_pms:
+        return False  # No PM is worth evacuating
+
+    mean_waste = total_waste / len(pm_fragmentation)
+    if mean_waste >= CONSOLIDATION_FRAGMENTATION_THRESHOLD:
+        return True
+
+    # Below the threshold, consolidate only if the idle power of the PMs that could be freed outweighs moving their VMs
+    num_freeable_pms = min(int(total_waste), num_light_pms)
+    freeable_pm_ids = sorted(
+        (pm_id for pm_id, (_, is_light) in pm_fragmentation.items() if is_light),
+        key=lambda pm_id: pm_fragmentation[pm_id][0],
+        reverse=True,
+    )[:num_freeable_pms]
+    vms_on_pms = get_vms_on_pms(active_vms, set(freeable_pm_ids))
+    savings = (
+        pue
+        * price["energy"]
+        * time_step
+        * CONSOLIDATION_SAVINGS_HORIZON
+        * sum(idle_power[pm_id] for pm_id in freeable_pm_ids)
+    )
+    costs = (
+        pue
+        * price["energy"]
+        * sum(vm["migration"]["energy"] for vms in vms_on_pms.values() for vm in vms)
+    )
+    if savings > costs:
+        return True
+
+    print(
+        color_text(
+            f"\nCluster fragmentation {mean_waste:.2f} is low, skipping consolidation for time step {step}...",
+            Fore.YELLOW,
+        )
+    )
+    return False
+
+
 def execute_time_step(
     active_vms,
     completed_migrations_in_step,
@@ -1068,6 +1498,7 @@ def simulate_time_steps(
     micro_model_max_pms,
     micro_model_max_vms,
     migration_model_max_fragmented_pms,
+    migration_model_max_candidate_pms,
     failed_migrations_limit,
     pm_manager_max_pms,
     hard_time_limit_macro,
@@ -1100,10 +1531,7 @@ def simulate_time_steps(
     completed_migrations_in_step = []
     terminated_vms = []
     terminated_vms_in_step = []
-    is_new_vms_arrival = False
-    is_vms_terminated = False
-    is_migration_completed = False
-    is_pms_turned_on = False
+    state_events = set()
     max_percentage_of_pms_on = 0
     num_completed_migrations = 0
     total_cpu_load = 0.0
@@ -1160,7 +1588,7 @@ def simulate_time_steps(
                 vms_in_step.append(vm)
 
             if len(vms_in_step) > 0:
-                is_new_vms_arrival = True
+                state_events.add("new_vms_arrival")
                 for vm in vms_in_step:
                     vm["arrival_step"] = step
         else:
@@ -1169,7 +1597,7 @@ def simulate_time_steps(
                 new_vms_per_step, initial_vm_ids, pattern=new_vms_pattern, step=step
             )
             if len(new_vms) > 0:
-                is_new_vms_arrival = True
+                state_events.add("new_vms_arrival")
             for vm in new_vms:
                 active_vms[vm["id"]] = vm
                 vm["arrival_step"] = step
@@ -1200,139 +1628,141 @@ def simulate_time_steps(
             if physical_machines[pm_id]["s"]["time_to_turn_on"] < time_step
         ]
         if len(pms_turn_on) > 0:
-            is_pms_turned_on = True
+            state_events.add("pms_turned_on")
 
-        is_state_changed = (
-            is_new_vms_arrival
-            or is_vms_terminated
-            or is_migration_completed
-            or is_pms_turned_on
-        )
+        non_allocated_vms = get_non_allocated_workload(active_vms, scheduled_vms)
+        phases_to_run = get_phases_to_run(algorithm, state_events, non_allocated_vms)
 
-        if not is_state_changed:
+        if not phases_to_run:
             algorithm_to_run = "none"
 
         # Call the appropriate model function
         if algorithm_to_run == "maxi":
             start_time = time.time()
-            launch_macro_model(
-                active_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                macro_model_max_subsets,
-                macro_model_max_pms,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                step,
-                time_step,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_macro,
-                hard_time_limit_micro,
-                performance_log_file,
-                algorithm,
-            )
+            if "macro" in phases_to_run:
+                launch_macro_model(
+                    active_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    macro_model_max_subsets,
+                    macro_model_max_pms,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    step,
+                    time_step,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_macro,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                    algorithm,
+                )
             end_time = time.time()
 
         elif algorithm_to_run == "mini":
-            non_allocated_vms = get_non_allocated_workload(active_vms, scheduled_vms)
-
             start_time = time.time()
-            launch_micro_model(
-                active_vms,
-                non_allocated_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_micro,
-                performance_log_file,
-            )
+            if "micro" in phases_to_run:
+                launch_micro_model(
+                    active_vms,
+                    non_allocated_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                )
             end_time = time.time()
 
         elif algorithm_to_run == "hybrid":
-            non_allocated_vms = get_non_allocated_workload(active_vms, scheduled_vms)
-
             start_time = time.time()
-            launch_micro_model(
-                active_vms,
-                non_allocated_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_micro,
-                performance_log_file,
-            )
-            launch_macro_model(
-                active_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                macro_model_max_subsets,
-                macro_model_max_pms,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                step,
-                time_step,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_macro,
-                hard_time_limit_micro,
-                performance_log_file,
-                algorithm,
-            )
+            if "micro" in phases_to_run:
+                launch_micro_model(
+                    active_vms,
+                    non_allocated_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                )
+            if "macro" in phases_to_run and should_consolidate(
+                active_vms, physical_machines, idle_power, step, time_step
+            ):
+                launch_macro_model(
+                    active_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    macro_model_max_subsets,
+                    macro_model_max_pms,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    step,
+                    time_step,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_macro,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                    algorithm,
+                )
             end_time = time.time()
         elif algorithm_to_run == "compound":
             physical_machines_on_copy = physical_machines_on.copy()
-            non_allocated_vms = get_non_allocated_workload(active_vms, scheduled_vms)
 
             start_time = time.time()
-            launch_micro_model(
-                active_vms,
-                non_allocated_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_micro,
-                performance_log_file,
-            )
+            if "micro" in phases_to_run:
+                launch_micro_model(
+                    active_vms,
+                    non_allocated_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                )
 
-            launch_migration_model(
-                active_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                migration_model_max_fragmented_pms,
-                energy_intensity_database,
-                nb_points,
-                performance_log_file,
-                hard_time_limit_migration,
-                failed_migrations_limit,
-            )
+            if "migration" in phases_to_run and should_consolidate(
+                active_vms, physical_machines, idle_power, step, time_step
+            ):
+                launch_migration_model(
+                    active_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    migration_model_max_fragmented_pms,
+                    energy_intensity_database,
+                    nb_points,
+                    performance_log_file,
+                    hard_time_limit_migration,
+                    failed_migrations_limit,
+                    migration_model_max_candidate_pms,
+                )
 
             # If there is any non-allocated VM and any PM scheduled to turn off, try to allocate the VMs on the PMs
             if len(pms_to_turn_off_after_migration) > 0:
@@ -1364,39 +1794,43 @@ def simulate_time_steps(
             end_time = time.time()
         elif algorithm_to_run == "multilayer":
             physical_machines_on_copy = physical_machines_on.copy()
-            non_allocated_vms = get_non_allocated_workload(active_vms, scheduled_vms)
 
             start_time = time.time()
-            launch_micro_model(
-                active_vms,
-                non_allocated_vms,
-                scheduled_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                micro_model_max_pms,
-                micro_model_max_vms,
-                idle_power,
-                energy_intensity_database,
-                nb_points,
-                hard_time_limit_micro,
-                performance_log_file,
-            )
+            if "micro" in phases_to_run:
+                launch_micro_model(
+                    active_vms,
+                    non_allocated_vms,
+                    scheduled_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    micro_model_max_pms,
+                    micro_model_max_vms,
+                    idle_power,
+                    energy_intensity_database,
+                    nb_points,
+                    hard_time_limit_micro,
+                    performance_log_file,
+                )
 
-            launch_migration_model(
-                active_vms,
-                physical_machines_on,
-                pms_to_turn_off_after_migration,
-                step,
-                time_step,
-                migration_model_max_fragmented_pms,
-                energy_intensity_database,
-                nb_points,
-                performance_log_file,
-                hard_time_limit_migration,
-                failed_migrations_limit,
-            )
+            if "migration" in phases_to_run and should_consolidate(
+                active_vms, physical_machines, idle_power, step, time_step
+            ):
+                launch_migration_model(
+                    active_vms,
+                    physical_machines_on,
+                    pms_to_turn_off_after_migration,
+                    step,
+                    time_step,
+                    migration_model_max_fragmented_pms,
+                    energy_intensity_database,
+                    nb_points,
+                    performance_log_file,
+                    hard_time_limit_migration,
+                    failed_migrations_limit,
+                    migration_model_max_candidate_pms,
+                )
 
             # If there is any non-allocated VM and any PM scheduled to turn off, try to allocate the VMs on the PMs
             if len(pms_to_turn_off_after_migration) > 0:
@@ -1427,14 +1861,15 @@ def simulate_time_steps(
                                 del pms_to_turn_off_after_migration[pm_id]
 
             if use_load_balancer:
-                run_load_balancer(
-                    active_vms,
-                    physical_machines_on_copy,
-                    pms_to_turn_off_after_migration,
-                    energy_intensity_database,
-                    step,
-                    performance_log_file,
-                )
+                if "load_balancer" in phases_to_run:
+                    run_load_balancer(
+                        active_vms,
+                        physical_machines_on_copy,
+                        pms_to_turn_off_after_migration,
+                        energy_intensity_database,
+                        step,
+                        performance_log_file,
+                    )
             end_time = time.time()
         elif algorithm_to_run == "backup":
             start_time = time.time()
@@ -1548,12 +1983,9 @@ def simulate_time_steps(
                 physical_machines, initial_physical_machines, is_on
             )
 
-        if algorithm_to_run != "none":
-            is_new_vms_arrival = False
-            is_vms_terminated = False
-            is_migration_completed = False
-            is_pms_turned_on = False
+        state_events.clear()
 
+        if algorithm_to_run != "none":
             total_algorithm_runtime += end_time - start_time
 
             # Calculate and update load
@@ -1621,9 +2053,9 @@ def simulate_time_steps(
         num_completed_migrations += len(completed_migrations_in_step)
 
         if len(completed_migrations_in_step) > 0:
-            is_migration_completed = True
+            state_events.add("migration_completed")
         if terminated_vms_in_step:
-            is_vms_terminated = True
+            state_events.add("vms_terminated")
 
         # Calculate and update load
         cpu_load, memory_load = calculate_load(physical_machines, active_vms, time_step)
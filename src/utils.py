@@ -7,7 +7,10 @@ import numpy as np
 import pandas as pd
 from colorama import Style
 
+from artifacts import write_model_artifact
 from config import (
+    ANYTIME_MAX_GAP,
+    ANYTIME_SOLVING,
     MACRO_MODEL_INPUT_FOLDER_PATH,
     PM_DATABASE_FILE,
     ENERGY_INTENSITY_FILE,
@@ -368,10 +371,12 @@ def load_pm_database(composition, shape="average"):
     )
 
 
-def load_configuration(folder_path, epgap):
+def load_configuration(folder_path, epgap, time_limit=0):
     weights_data = f"""
 epgap = {epgap};
 
+time_limit = {time_limit};
+
 price = <{price['cpu']}, {price['memory']}, {price['energy']}>;
 
 PUE = {pue};
@@ -458,16 +463,19 @@ def save_energy_intensity(file_path):
 def convert_energy_intensity_to_model_input_format(
     pms, energy_intensity_database, nb_points
 ):
-    output_content = f"\n\nnb_points = {nb_points};\n\nenergy_intensity_function = [\n"
+    # One energy intensity table per PM type, referenced by the type of each PM
+    pm_types = sorted({pm["type"] for pm in pms.values()})
+    formatted_pm_types = ", ".join(str(pm_type) for pm_type in pm_types)
+    output_content = f"\n\nnb_points = {nb_points};\n\npm_types = {{{formatted_pm_types}}};\n\nenergy_intensity_function = #[\n"
 
-    for pm in pms.values():
-        energy_intensity_dict = energy_intensity_database[pm["type"]]
+    for pm_type in pm_types:
+        energy_intensity_dict = energy_intensity_database[pm_type]
         formatted_values = ", ".join(
             f"<{x}, {value}>" for x, value in energy_intensity_dict.items()
         )
-        output_content += f"  [{formatted_values}],\n"
+        output_content += f"  {pm_type}: [{formatted_values}],\n"
 
-    output_content = output_content.rstrip(",\n") + "\n];\n"
+    output_content = output_content.rstrip(",\n") + "\n]#;\n"
     return output_content
 
 
@@ -489,12 +497,46 @@ def convert_pms_to_model_input_format(pms):
     return formatted_pms
 
 
+def convert_residual_loads_to_model_input_format(pms, fixed_vms_on_pms):
+    legend = "// <pm, requested (cpu, memory), count> of the VMs kept in place on each PM\n"
+    formatted_residual_loads = "\n\n" + legend + "\nresidual_loads = {\n"
+    fixed_migration_penalty = 0.0
+
+    for pm_id in pms.keys():
+        fixed_vms = fixed_vms_on_pms.get(pm_id, [])
+        cpu = sum(vm["requested"]["cpu"] for vm in fixed_vms)
+        memory = sum(vm["requested"]["memory"] for vm in fixed_vms)
+        formatted_residual_loads += f"  <{pm_id}, <{cpu}, {memory}>, {len(fixed_vms)}>,\n"
+
+        # Ongoing migrations keep their penalty in the objective
+        for vm in fixed_vms:
+            remaining_run_time = vm["run"]["total_time"] - vm["run"]["current_time"]
+            if vm["migration"]["from_pm"] != -1 and remaining_run_time > 0:
+                revenue = (
+                    vm["requested"]["cpu"] * price["cpu"]
+                    + vm["requested"]["memory"] * price["memory"]
+                )
+                fixed_migration_penalty += (
+                    vm["migration"]["energy"] * pue * price["energy"]
+                    + revenue * vm["migration"]["down_time"]
+                ) / remaining_run_time
+
+    formatted_residual_loads = formatted_residual_loads.rstrip(",\n") + "\n};\n"
+    formatted_residual_loads += (
+        f"\nfixed_migration_penalty = {fixed_migration_penalty};\n"
+    )
+    return formatted_residual_loads
+
+
 def save_model_input_format(
-    vms, pms, step, model_input_folder_path, energy_intensity_database, nb_points
+    vms,
+    pms,
+    step,
+    model_input_folder_path,
+    energy_intensity_database,
+    nb_points,
+    fixed_vms_on_pms=None,
 ):
-    # Ensure the directory exists
-    os.makedirs(model_input_folder_path, exist_ok=True)
-
     # Construct file paths
     base_filename = f"_t{step}.dat"
     vm_filename = "virtual_machines" + base_filename
@@ -508,15 +550,18 @@ def save_model_input_format(
     formatted_energy_intensity = convert_energy_intensity_to_model_input_format(
         pms, energy_intensity_database, nb_points
     )
+    formatted_residual_loads = convert_residual_loads_to_model_input_format(
+        pms, fixed_vms_on_pms or {}
+    )
 
     # Write formatted VMs to file
-    with open(vm_model_input_file_path, "w", encoding="utf-8") as vm_file:
-        vm_file.write(formatted_vms)
+    write_model_artifact(vm_model_input_file_path, formatted_vms)
 
-    # Write formatted PMs and power function to file
-    with open(pm_model_input_file_path, "w", encoding="utf-8") as pm_file:
-        pm_file.write(formatted_pms)
-        pm_file.write(formatted_energy_intensity)
+    # Write formatted PMs, power function and residual loads to file
+    write_model_artifact(
+        pm_model_input_file_path,
+        formatted_pms + formatted_energy_intensity + formatted_residual_loads,
+    )
 
     return vm_model_input_file_path, pm_model_input_file_path
 
@@ -562,6 +607,30 @@ def get_opl_return_code(output):
         return None
 
 
+def get_opl_mip_gap(output):
+    pattern = r"mip_gap = ([-+]?[\d.eE+-]+);"
+
+    # Search for the pattern in the input string
+    match = re.search(pattern, output)
+
+    if match:
+        return float(match.group(1))
+    else:
+        return None
+
+
+def get_opl_cplex_status(output):
+    pattern = r"cplex_status = (\d+);"
+
+    # Search for the pattern in the input string
+    match = re.search(pattern, output)
+
+    if match:
+        return int(match.group(1))
+    else:
+        return None
+
+
 def is_opl_output_valid(output, return_code):
     if return_code != 0:
         return False
@@ -570,14 +639,33 @@ def is_opl_output_valid(output, return_code):
     time_limit_exceeded_keyword = "time limit exceeded"
     no_solution_keyword = "no solution"
 
-    if (
-        time_limit_exceeded_keyword in output_lower
-        or no_solution_keyword in output_lower
-    ):
+    if no_solution_keyword in output_lower:
         return False
+    if time_limit_exceeded_keyword in output_lower:
+        # Accept the best incumbent found within the time limit if its gap is small enough
+        mip_gap = get_opl_mip_gap(output)
+        return mip_gap is not None and mip_gap <= ANYTIME_MAX_GAP
     return True
 
 
+def is_highs_result_valid(parsed_data, status, mip_gap):
+    # Same acceptance as the OPL output, scipy.optimize.milp status 1 is the time limit
+    if parsed_data is None:
+        return False
+    if status == 1:
+        return (
+            ANYTIME_SOLVING and mip_gap is not None and mip_gap <= ANYTIME_MAX_GAP
+        )
+    return status == 0
+
+
+def is_opl_output_optimal(output, return_code):
+    # Valid output whose CPLEX status is CPXMIP_OPTIMAL or CPXMIP_OPTIMAL_TOL
+    return is_opl_output_valid(output, return_code) and get_opl_cplex_status(
+        output
+    ) in (101, 102)
+
+
 def parse_matrix(matrix_str):
     return [
         [int(num) if num.isdigit() else float(num) for num in row.strip().split()]
@@ -610,6 +698,16 @@ def evaluate_piecewise_linear_function(piecewise_function, x_value):
     return y
 
 
+def evaluate_piecewise_linear_function_array(piecewise_function, x_values):
+    """
+    Evaluate a piecewise linear function at every value of an array.
+    """
+    x_points = np.array([float(xi) for xi in piecewise_function.keys()])
+    y_points = np.array(list(piecewise_function.values()), dtype=float)
+
+    return np.interp(x_values, x_points, y_points)
+
+
 def round_down(value):
     return math.floor(value * 1000000) / 1000000
 